@@ -1,9 +1,13 @@
 import os
-import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from llama_index.llms.ollama import Ollama
-from llama_index.core import Settings, PromptTemplate
-from hybrid_retrieval import retrieve_and_rerank
+from llm_gateway import get_gateway, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from metadata_filters import SearchFilters
+from profiling import profiled
+
+# LlamaIndex, Qdrant and torch are imported inside the functions that need
+# them, so argument errors and --help return immediately
 
 # Load environment variables
 load_dotenv()
@@ -11,15 +15,8 @@ load_dotenv()
 # Configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL")
 LLM_MODEL_NAME = "llama3.1:8b"
-
-# Initialize LLM
-llm = Ollama(
-    model=LLM_MODEL_NAME,
-    base_url=OLLAMA_BASE_URL,
-    request_timeout=120.0,
-    context_window=4096,
-    additional_kwargs={"num_ctx": 4096}
-)
+NO_ANSWER = "Jeg kunne ikke finde information om dette i databasen."
+ANSWER_FAILED = "Svaret kunne ikke genereres."
 
 # Define a simple RAG Prompt
 QA_PROMPT_TMPL = (
@@ -33,45 +30,119 @@ QA_PROMPT_TMPL = (
     "Spørgsmål: {query_str}\n"
     "Svar:"
 )
-qa_prompt = PromptTemplate(QA_PROMPT_TMPL)
 
-def generate_answer(query: str):
+def answer_from_nodes(query: str, nodes, priority: int = PRIORITY_INTERACTIVE) -> str:
     """
-    1. Retrieve relevant context (Hybrid + Rerank)
-    2. Format prompt
-    3. Generate answer via LLM
+    Formats the packed context into the prompt and generates one answer.
     """
-    print(f"\n✈️  Behandler spørgsmål: '{query}'")
-    
-    # 1. Retrieval
-    print("🔍 Henter viden...")
-    nodes = retrieve_and_rerank(query, top_k=10, rerank_top_n=3)
-    
+    from llama_index.core import PromptTemplate
+    from context_packing import assemble_context, context_budget
+    from parent_store import expand_to_parents
+
     if not nodes:
         print("⚠️  Ingen relevante data fundet.")
-        return "Jeg kunne ikke finde information om dette i databasen."
+        return NO_ANSWER
 
-    # 2. Format Context
-    context_str = "\n\n".join([n.node.get_text() for n in nodes])
-    print(f"📄 Brugte {len(nodes)} kilder til kontekst.")
+    # Format Context (parent sections, merged, deduplicated and packed to the token budget)
+    nodes = expand_to_parents(nodes)
+    context_str, passages = assemble_context(nodes, context_budget(QA_PROMPT_TMPL, query))
+    print(f"📄 Brugte {len(passages)} kilder til kontekst.")
 
-    # 3. Generate
+    # Generate
     print("🧠 Genererer svar med Llama 3.1...")
-    prompt = qa_prompt.format(context_str=context_str, query_str=query)
+    prompt = PromptTemplate(QA_PROMPT_TMPL).format(context_str=context_str, query_str=query)
     
-    response = llm.complete(prompt)
+    # Shared client config, bounded concurrency
+    response = get_gateway(LLM_MODEL_NAME).complete(prompt, priority=priority)
     
     return str(response)
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        query = " ".join(sys.argv[1:])
-    else:
-        query = "forklar MOB funktionen"
-        
-    answer = generate_answer(query)
+def generate_answer(query: str, filters: SearchFilters | None = None):
+    """
+    1. Retrieve relevant context (Hybrid + Rerank)
+    2. Format prompt
+    3. Generate answer via LLM
+    """
+    from hybrid_retrieval import retrieve_and_rerank
+
+    print(f"\n✈️  Behandler spørgsmål: '{query}'")
+
+    # Load the model into Ollama while retrieval and reranking run
+    gateway = get_gateway(LLM_MODEL_NAME)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        warm_up = pool.submit(gateway.warm_up)
+
+        # 1. Retrieval
+        print("🔍 Henter viden...")
+        nodes = retrieve_and_rerank(query, top_k=10, rerank_top_n=3, filters=filters)
+
+        try:
+            warm_up.result()
+        except Exception as e:
+            print(f"⚠️ LLM warm-up failed: {e}")
+
+    return answer_from_nodes(query, nodes)
+
+def generate_answers(queries: list[str], filters: SearchFilters | None = None) -> list[str]:
+    """
+    Batch mode: retrieval and reranking run once for all questions,
+    then the LLM calls fan out with bounded concurrency. A question whose
+    answer fails gets an error text; the others are still answered.
+    """
+    from hybrid_retrieval import batch_retrieve_and_rerank
+
+    print(f"\n✈️  Behandler {len(queries)} spørgsmål i batch...")
+    print("🔍 Henter viden...")
+    ranked = batch_retrieve_and_rerank(queries, top_k=10, rerank_top_n=3, filters=filters)
+
+    def answer_or_error(query, nodes):
+        try:
+            return answer_from_nodes(query, nodes, PRIORITY_BATCH)
+        except Exception as e:
+            print(f"❌ Spørgsmål fejlede: '{query}': {e}")
+            return f"{ANSWER_FAILED} ({type(e).__name__}: {e})"
+
+    with ThreadPoolExecutor(max_workers=get_gateway(LLM_MODEL_NAME).max_concurrency) as pool:
+        return list(pool.map(answer_or_error, queries, ranked))
+
+def print_answer(answer: str, query: str | None = None):
     print("\n" + "="*30)
-    print("SVAR:")
+    print(f"SVAR: {query}" if query else "SVAR:")
     print("="*30)
     print(answer)
-    print("="*30 + "\n")
\ No newline at end of file
+    print("="*30 + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ask Buddy RAG a question.")
+    parser.add_argument("query", nargs="*", help="Question (default: 'forklar MOB funktionen')")
+    parser.add_argument("--batch", metavar="FILE", help="File with one question per line")
+    filter_args = parser.add_argument_group("filters")
+    filter_args.add_argument("--document", action="append", metavar="ID",
+                             help="Only search this document, e.g. 3 or paperless:3 (repeatable)")
+    filter_args.add_argument("--tag", action="append", type=int, metavar="TAG_ID", help="Paperless tag id (repeatable)")
+    filter_args.add_argument("--source", help="Document source, e.g. paperless")
+    filter_args.add_argument("--from", dest="created_from", metavar="YYYY-MM-DD", help="Created on or after")
+    filter_args.add_argument("--to", dest="created_to", metavar="YYYY-MM-DD", help="Created on or before")
+    parser.add_argument("--profile", action="store_true", help="Write a sampling profile (speedscope) of the run")
+    args = parser.parse_args()
+
+    filters = SearchFilters(
+        documents=args.document,
+        tags=args.tag,
+        source=args.source,
+        created_from=args.created_from,
+        created_to=args.created_to,
+    )
+
+    if args.batch:
+        with open(args.batch, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        with profiled("cli-batch", enabled=args.profile):
+            answers = generate_answers(queries, filters)
+        for query, answer in zip(queries, answers):
+            print_answer(answer, query)
+    else:
+        query = " ".join(args.query) if args.query else "forklar MOB funktionen"
+        with profiled("cli-query", enabled=args.profile):
+            answer = generate_answer(query, filters)
+        print_answer(answer)
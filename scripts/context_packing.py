@@ -0,0 +1,193 @@
+import os
+import re
+from dotenv import load_dotenv
+from llama_index.core.schema import TextNode, NodeWithScore
+from token_counting import get_token_counter
+from markdown_chunker import HEADING_RE, LIST_ITEM_RE, TABLE_ROW_RE, TABLE_SEPARATOR_RE
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", 4096))
+NUM_OUTPUT = int(os.getenv("LLM_NUM_OUTPUT", 512))
+DUPLICATE_THRESHOLD = 0.8  # share of the smaller passage's word shingles
+SHINGLE_SIZE = 3
+MIN_TEXT_OVERLAP = 20  # chars, matches SentenceSplitter(chunk_overlap=20)
+MAX_TEXT_OVERLAP = 2000
+PASSAGE_SEPARATOR = "\n\n"
+
+def context_budget(prompt_template: str, query: str) -> int:
+    """
+    Tokens left for context once the prompt itself and the answer are accounted for.
+    """
+    counter = get_token_counter()
+    prompt_tokens = counter.count(prompt_template.format(context_str="", query_str=query))
+    return max(0, CONTEXT_WINDOW - NUM_OUTPUT - prompt_tokens)
+
+def _doc_key(node: TextNode):
+    return node.ref_doc_id or node.metadata.get("doc_id") or node.metadata.get("file_name")
+
+def _text_overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of `left` that is a prefix of `right`."""
+    max_len = min(len(left), len(right), MAX_TEXT_OVERLAP)
+    for size in range(max_len, MIN_TEXT_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+def _is_line_element(line: str) -> bool:
+    return bool(HEADING_RE.match(line) or LIST_ITEM_RE.match(line) or TABLE_ROW_RE.match(line))
+
+def _continues_table(left: str, right: str) -> str:
+    """
+    `right` without the table header the chunker repeats on each piece of a
+    split table, when `left` ends inside that table.
+    """
+    lines = right.split("\n", 2)
+    if (
+        len(lines) == 3
+        and TABLE_ROW_RE.match(left.rsplit("\n", 1)[-1])
+        and TABLE_ROW_RE.match(lines[0])
+        and TABLE_SEPARATOR_RE.match(lines[1])
+    ):
+        return lines[2]
+    return right
+
+def _separator(left: str, right: str, gap: int) -> str:
+    """
+    Whitespace between two touching chunks, as in the source: chunks are cut
+    at blank lines between blocks and at single spaces or newlines inside one.
+    """
+    if gap >= 2:
+        return PASSAGE_SEPARATOR
+    if gap == 0:
+        return ""
+    if _is_line_element(left.rsplit("\n", 1)[-1]) or _is_line_element(right.split("\n", 1)[0]):
+        return "\n"
+    return " "
+
+def _join(left: TextNode, right: TextNode) -> str | None:
+    """
+    Joins two chunks of the same document if they touch or overlap, else None.
+    Uses char offsets when both chunks have them, otherwise text overlap.
+    """
+    if None not in (left.end_char_idx, right.start_char_idx):
+        gap = right.start_char_idx - left.end_char_idx
+        if gap > 2:
+            return None
+        if right.end_char_idx is not None and right.end_char_idx <= left.end_char_idx:
+            return left.text  # right lies inside left
+        right_text = _continues_table(left.text, right.text) if gap < 2 else right.text
+        if gap >= 0:
+            return left.text + _separator(left.text, right_text, gap) + right_text
+        # Offsets are approximate; prefer the exact text overlap when found
+        overlap = _text_overlap(left.text, right_text) or min(-gap, len(right_text))
+        return left.text + right_text[overlap:]
+
+    if right.text in left.text:
+        return left.text
+    overlap = _text_overlap(left.text, right.text)
+    if overlap:
+        return left.text + right.text[overlap:]
+    return None
+
+def _end(left: TextNode, right: TextNode) -> int | None:
+    if left.end_char_idx is None or right.end_char_idx is None:
+        return right.end_char_idx
+    return max(left.end_char_idx, right.end_char_idx)
+
+def merge_adjacent(nodes: list[NodeWithScore], max_tokens: int | None = None) -> list[NodeWithScore]:
+    """
+    Merges chunks that are adjacent in the same source document, removing
+    the text duplicated by the splitter's chunk overlap.
+    A merged passage keeps the best score of its parts. With `max_tokens`,
+    a passage stops growing before it would exceed that many tokens.
+    """
+    counter = get_token_counter()
+    groups = {}
+    for n in nodes:
+        groups.setdefault(_doc_key(n.node), []).append(n)
+
+    merged = []
+    for key, group in groups.items():
+        if key is None:
+            merged.extend(group)
+            continue
+
+        group.sort(key=lambda n: n.node.start_char_idx if n.node.start_char_idx is not None else 0)
+        current = group[0]
+        for n in group[1:]:
+            text = _join(current.node, n.node)
+            if text is None:
+                merged.append(current)
+                current = n
+                continue
+            candidate = NodeWithScore(
+                node=TextNode(
+                    id_=current.node.node_id,
+                    text=text,
+                    metadata=current.node.metadata,
+                    relationships=current.node.relationships,
+                    start_char_idx=current.node.start_char_idx,
+                    end_char_idx=_end(current.node, n.node),
+                ),
+                score=max(current.score or 0.0, n.score or 0.0),
+            )
+            if max_tokens is not None and counter.count(candidate.node.get_content()) > max_tokens:
+                merged.append(current)
+                current = n
+                continue
+            current = candidate
+        merged.append(current)
+    return merged
+
+def _shingles(text: str) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def _is_duplicate(shingles: set, selected: list[set]) -> bool:
+    # Overlap coefficient rather than Jaccard, so a chunk contained in a
+    # merged passage counts as a duplicate of it
+    for other in selected:
+        smaller = min(len(shingles), len(other))
+        if smaller and len(shingles & other) / smaller >= DUPLICATE_THRESHOLD:
+            return True
+    return False
+
+def assemble_context(nodes: list[NodeWithScore], budget: int) -> tuple[str, list[NodeWithScore]]:
+    """
+    Packs reranked nodes into a single context string of at most `budget` tokens.
+
+    1. Merge adjacent chunks from the same document, up to the budget
+    2. Drop near-duplicate passages
+    3. Fill the budget greedily by reranker score
+
+    Returns the context string and the passages it contains.
+    """
+    counter = get_token_counter()
+    separator_tokens = counter.count(PASSAGE_SEPARATOR)
+
+    passages = sorted(merge_adjacent(nodes, max_tokens=budget), key=lambda n: n.score or 0.0, reverse=True)
+
+    selected = []
+    selected_shingles = []
+    used = 0
+    for passage in passages:
+        text = passage.node.get_content()
+        shingles = _shingles(text)
+        if _is_duplicate(shingles, selected_shingles):
+            continue
+
+        cost = counter.count(text) + (separator_tokens if selected else 0)
+        if used + cost > budget:
+            continue
+
+        selected.append(passage)
+        selected_shingles.append(shingles)
+        used += cost
+
+    context_str = PASSAGE_SEPARATOR.join(n.node.get_content() for n in selected)
+    return context_str, selected
@@ -1,14 +1,19 @@
 import os
-import requests
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from qdrant_client import QdrantClient
 from llama_index.core import Settings, VectorStoreIndex, QueryBundle
 from llama_index.core.retrievers import BaseRetriever, VectorIndexRetriever
-from llama_index.retrievers.bm25 import BM25Retriever
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.core.schema import TextNode, NodeWithScore
+from llama_index.core.schema import TextNode, NodeWithScore, MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from lexical_index import LexicalRetriever, get_lexical_index
+from retrieval_cache import (
+    candidate_key, get_candidates, put_candidates, get_query_embedding, get_query_embeddings
+)
+from robustness import call_protected, check_deadline
+from metadata_filters import SearchFilters, active_filters, to_qdrant_filter
 from typing import List, Optional
 
 # Load environment variables
@@ -19,116 +24,187 @@ QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION")
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL")
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL")
-
-# Initialize Global Settings
-Settings.embed_model = OllamaEmbedding(
-    model_name=EMBED_MODEL_NAME,
-    base_url=OLLAMA_BASE_URL,
+RERANK_MODEL_NAME = "BAAI/bge-reranker-v2-m3"
+# Local snapshot of the reranker; loading it skips the Hugging Face hub lookups
+RERANK_SNAPSHOT_DIR = os.getenv(
+    "RERANK_SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "models", RERANK_MODEL_NAME.replace("/", "--")),
 )
-Settings.llm = None 
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 64))
+# Send a second query embedding / vector search if the first is slower than this; unset disables hedging
+HEDGE_DELAY_S = float(os.getenv("HEDGE_DELAY_S")) if os.getenv("HEDGE_DELAY_S") else None
+
+# Heavy clients (Ollama embeddings, Qdrant, sentence-transformers/torch) are
+# imported on first use, so importing this module stays cheap
+_embed_model = None
+_embed_model_lock = threading.Lock()
+
+def get_embed_model():
+    """Returns the shared query embedding client, creating it on first use."""
+    global _embed_model
+    if _embed_model is None:
+        with _embed_model_lock:
+            if _embed_model is None:
+                from llama_index.embeddings.ollama import OllamaEmbedding
+
+                _embed_model = OllamaEmbedding(
+                    model_name=EMBED_MODEL_NAME,
+                    base_url=OLLAMA_BASE_URL,
+                )
+                Settings.embed_model = _embed_model
+    return _embed_model
 
 class HybridRetriever(BaseRetriever):
     """
     Custom Hybrid Retriever combining BM25 and Vector Search.
     """
-    def __init__(self, vector_retriever, bm25_retriever):
+    def __init__(self, vector_retriever, bm25_retriever, top_k=5, filters: SearchFilters | None = None):
         self.vector_retriever = vector_retriever
         self.bm25_retriever = bm25_retriever
+        self.top_k = top_k
+        self.filters = active_filters(filters)
         super().__init__()
 
+    def with_filters(self, filters: SearchFilters | None) -> "HybridRetriever":
+        """A per-request copy that searches only points matching `filters`."""
+        filters = active_filters(filters)
+        if filters is None:
+            return self
+        return HybridRetriever(
+            filtered_vector_retriever(self.vector_retriever, filters),
+            LexicalRetriever(similarity_top_k=self.bm25_retriever.similarity_top_k, filters=filters),
+            top_k=self.top_k,
+            filters=filters,
+        )
+
     def _retrieve(self, query_bundle: QueryBundle):
+        key = candidate_key(query_bundle.query_str, self.top_k, self.filters)
+        cached = get_candidates(key)
+        if cached is not None:
+            print("♻️ Using cached retrieval candidates.")
+            return cached
+
+        # A memoized embedding lets the vector retriever skip the Ollama call
+        if query_bundle.embedding is None:
+            embed_model = get_embed_model()
+            query_bundle.embedding = get_query_embedding(
+                embed_model,
+                query_bundle.query_str,
+                compute=lambda q: call_protected(
+                    "ollama-embed", embed_model.get_query_embedding, q, hedge_after=HEDGE_DELAY_S
+                ),
+            )
+
         bm25_nodes = self.bm25_retriever.retrieve(query_bundle)
-        vector_nodes = self.vector_retriever.retrieve(query_bundle)
+        vector_nodes = call_protected(
+            "qdrant", self.vector_retriever.retrieve, query_bundle, hedge_after=HEDGE_DELAY_S
+        )
+        nodes = fuse_results(vector_nodes, bm25_nodes)
+        put_candidates(key, nodes)
+        return nodes
 
-        all_nodes = []
-        node_ids = set()
-        
-        for node in vector_nodes:
-            if node.node.node_id not in node_ids:
-                all_nodes.append(node)
-                node_ids.add(node.node.node_id)
-        
-        for node in bm25_nodes:
-            if node.node.node_id not in node_ids:
-                all_nodes.append(node)
-                node_ids.add(node.node.node_id)
+def fuse_results(vector_nodes: List[NodeWithScore], bm25_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+    """Union of both result lists, vector hits first, deduplicated by node id."""
+    all_nodes = []
+    node_ids = set()
+
+    for node in vector_nodes:
+        if node.node.node_id not in node_ids:
+            all_nodes.append(node)
+            node_ids.add(node.node.node_id)
 
-        return all_nodes
+    for node in bm25_nodes:
+        if node.node.node_id not in node_ids:
+            all_nodes.append(node)
+            node_ids.add(node.node.node_id)
+
+    return all_nodes
+
+def filtered_vector_retriever(vector_retriever: VectorIndexRetriever, filters: SearchFilters) -> VectorIndexRetriever:
+    """Same index and top-k, with the filter pushed down to Qdrant."""
+    return VectorIndexRetriever(
+        index=vector_retriever._index,
+        similarity_top_k=vector_retriever._similarity_top_k,
+        vector_store_kwargs={"qdrant_filters": to_qdrant_filter(filters)},
+    )
+
+def apply_filters(retriever, filters: SearchFilters | None):
+    """Restricts a retriever from get_hybrid_retriever (hybrid or vector-only fallback)."""
+    if active_filters(filters) is None:
+        return retriever
+    if isinstance(retriever, HybridRetriever):
+        return retriever.with_filters(filters)
+    return filtered_vector_retriever(retriever, filters)
 
 def get_hybrid_retriever(top_k=5):
+    from qdrant_client import QdrantClient
+    from llama_index.vector_stores.qdrant import QdrantVectorStore
+
     client = QdrantClient(url=QDRANT_URL)
     vector_store = QdrantVectorStore(client=client, collection_name=QDRANT_COLLECTION)
-    index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+    index = VectorStoreIndex.from_vector_store(vector_store=vector_store, embed_model=get_embed_model())
     vector_retriever = VectorIndexRetriever(index=index, similarity_top_k=top_k)
 
-    print("⏳ Building BM25 Retriever (fetching docs from Qdrant)...")
+    print("⏳ Loading shared lexical index (memory-mapped)...")
     try:
-        all_docs = []
-        offset = None
-        while True:
-            points, next_offset = client.scroll(
-                collection_name=QDRANT_COLLECTION,
-                limit=100,
-                offset=offset,
-                with_payload=True,
-                with_vectors=False
-            )
-            for point in points:
-                text_content = point.payload.get("text", "")
-                if not text_content:
-                    node_content = point.payload.get("_node_content", "{}")
-                    if isinstance(node_content, str):
-                        try:
-                            import json
-                            nc = json.loads(node_content)
-                            text_content = nc.get("text", "")
-                        except:
-                            pass
-                
-                metadata = point.payload if isinstance(point.payload, dict) else {}
-
-                node = TextNode(
-                    text=text_content,
-                    id_=point.id,
-                    metadata=metadata
-                )
-                all_docs.append(node)
-            
-            offset = next_offset
-            if offset is None:
-                break
-        
-        print(f"📄 Fetched {len(all_docs)} nodes for BM25.")
-        bm25_retriever = BM25Retriever.from_defaults(nodes=all_docs, similarity_top_k=top_k)
-        
+        bm25_retriever = LexicalRetriever(similarity_top_k=top_k)
+        # Maps the current generation now, building it first if none exists yet
+        get_lexical_index()
     except Exception as e:
-        print(f"⚠️ Failed to build BM25 Retriever: {e}")
+        print(f"⚠️ Failed to load lexical index: {e}")
         return vector_retriever
 
-    return HybridRetriever(vector_retriever, bm25_retriever)
+    return HybridRetriever(vector_retriever, bm25_retriever, top_k=top_k)
+
+def save_reranker_snapshot(reranker, path: str = RERANK_SNAPSHOT_DIR):
+    """Saves the loaded cross-encoder (weights, tokenizer, config) as a local snapshot."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        reranker._model.save(tmp_path)
+        os.rename(tmp_path, path)
+        print(f"💾 Saved reranker snapshot to {path}.")
+    except OSError as e:
+        # Another process may have saved it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            print(f"⚠️ Failed to save reranker snapshot: {e}")
+
+def load_reranker(top_n: int):
+    # LlamaIndex has SentenceTransformerRerank in core.postprocessor.sbert_rerank
+    from llama_index.core.postprocessor.sbert_rerank import SentenceTransformerRerank
+
+    # First start downloads the official HF model and snapshots it locally;
+    # later starts load the snapshot from disk without contacting the hub.
+    # device="cpu" is safer for LXC unless GPU passthrough is confirmed.
+    has_snapshot = os.path.isdir(RERANK_SNAPSHOT_DIR)
+    model = RERANK_SNAPSHOT_DIR if has_snapshot else RERANK_MODEL_NAME
+    print(f"⚖️ Loading Local BGE-M3 reranker ({model})...")
+    reranker = SentenceTransformerRerank(
+        model=model,
+        top_n=top_n,
+        device="cpu"
+    )
+    if not has_snapshot:
+        save_reranker_snapshot(reranker)
+    return reranker
+
+def retrieve_and_rerank(query, top_k=10, rerank_top_n=3, filters: SearchFilters | None = None):
+    # The reranker (torch + model weights) loads in the background while we retrieve
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        reranker_future = pool.submit(load_reranker, rerank_top_n)
+
+        # 1. Get Hybrid Retriever
+        retriever = apply_filters(get_hybrid_retriever(top_k=top_k), filters)
+
+        # 2. Retrieve Nodes
+        print(f"🔍 Retrieving nodes for query: '{query}'")
+        nodes = retriever.retrieve(query)
+        print(f"📊 Found {len(nodes)} candidate nodes.")
 
-def retrieve_and_rerank(query, top_k=10, rerank_top_n=3):
-    # 1. Get Hybrid Retriever
-    retriever = get_hybrid_retriever(top_k=top_k)
-    
-    # 2. Retrieve Nodes
-    print(f"🔍 Retrieving nodes for query: '{query}'")
-    nodes = retriever.retrieve(query)
-    print(f"📊 Found {len(nodes)} candidate nodes.")
-    
     # 3. Rerank using Local SentenceTransformer (BGE-M3)
+    check_deadline("rerank")
     try:
-        # LlamaIndex has SentenceTransformerRerank in core.postprocessor.sbert_rerank
-        from llama_index.core.postprocessor.sbert_rerank import SentenceTransformerRerank
-        
-        print(f"⚖️ Reranking with Local BGE-M3 (BAAI/bge-reranker-v2-m3)...")
-        # We use the official HF model name. It will download to cache.
-        # device="cpu" is safer for LXC unless GPU passthrough is confirmed.
-        reranker = SentenceTransformerRerank(
-            model="BAAI/bge-reranker-v2-m3", 
-            top_n=rerank_top_n,
-            device="cpu" 
-        )
+        reranker = reranker_future.result()
         
         query_bundle = QueryBundle(query_str=query)
         ranked_nodes = reranker.postprocess_nodes(nodes, query_bundle)
@@ -142,6 +218,94 @@ def retrieve_and_rerank(query, top_k=10, rerank_top_n=3):
         print(f"⚠️ Reranking failed: {e}")
         return nodes[:rerank_top_n]
 
+def batch_retrieve(queries: List[str], top_k=10, filters: SearchFilters | None = None) -> List[List[NodeWithScore]]:
+    """
+    Hybrid retrieval for many queries at once:
+    one embedding request, one Qdrant batch search and one BM25 scoring pass.
+    `filters` apply to every query.
+    """
+    filters = active_filters(filters)
+    keys = [candidate_key(q, top_k, filters) for q in queries]
+    results = [get_candidates(k) for k in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return results
+    missing_queries = [queries[i] for i in missing]
+
+    print(f"🧬 Embedding {len(missing_queries)} queries in one request...")
+    embeddings = call_protected("ollama-embed", get_query_embeddings, get_embed_model(), missing_queries)
+
+    print(f"🔍 Batch vector search for {len(missing_queries)} queries...")
+    from qdrant_client import QdrantClient, models
+
+    client = QdrantClient(url=QDRANT_URL)
+    query_filter = to_qdrant_filter(filters)
+    responses = call_protected(
+        "qdrant",
+        client.query_batch_points,
+        collection_name=QDRANT_COLLECTION,
+        requests=[
+            models.QueryRequest(query=embedding, filter=query_filter, limit=top_k, with_payload=True)
+            for embedding in embeddings
+        ],
+    )
+    vector_results = [
+        [NodeWithScore(node=metadata_dict_to_node(point.payload), score=point.score) for point in response.points]
+        for response in responses
+    ]
+
+    try:
+        bm25_results = get_lexical_index().search_batch(missing_queries, top_k, filters)
+    except Exception as e:
+        print(f"⚠️ Lexical search failed, using vector results only: {e}")
+        bm25_results = [[] for _ in missing_queries]
+
+    for i, vector_nodes, bm25_nodes in zip(missing, vector_results, bm25_results):
+        results[i] = fuse_results(vector_nodes, bm25_nodes)
+        put_candidates(keys[i], results[i])
+    return results
+
+def rerank_batch(reranker, queries: List[str], candidates: List[List[NodeWithScore]], top_n: int) -> List[List[NodeWithScore]]:
+    """
+    Scores every (query, passage) pair in large cross-encoder batches,
+    instead of one predict call per query.
+    """
+    pairs = [
+        (query, node.node.get_content(metadata_mode=MetadataMode.EMBED))
+        for query, nodes in zip(queries, candidates)
+        for node in nodes
+    ]
+    if not pairs:
+        return [[] for _ in queries]
+
+    print(f"⚖️ Reranking {len(pairs)} pairs in batches of {RERANK_BATCH_SIZE}...")
+    scores = iter(reranker._model.predict(pairs, batch_size=RERANK_BATCH_SIZE))
+
+    results = []
+    for nodes in candidates:
+        scored = [NodeWithScore(node=node.node, score=float(next(scores))) for node in nodes]
+        scored.sort(key=lambda n: n.score, reverse=True)
+        results.append(scored[:top_n])
+    return results
+
+def batch_retrieve_and_rerank(queries: List[str], top_k=10, rerank_top_n=3, reranker=None, filters: SearchFilters | None = None):
+    candidates = batch_retrieve(queries, top_k=top_k, filters=filters)
+    print(f"📊 Found {sum(len(c) for c in candidates)} candidate nodes for {len(queries)} queries.")
+
+    check_deadline("rerank")
+    try:
+        reranker = reranker or load_reranker(rerank_top_n)
+        ranked = rerank_batch(reranker, queries, candidates, rerank_top_n)
+        print("✅ Reranking successful.")
+        return ranked
+    except ImportError:
+        print("⚠️ `sentence-transformers` library likely missing.")
+        print("Please run: pip install sentence-transformers")
+        return [c[:rerank_top_n] for c in candidates]
+    except Exception as e:
+        print(f"⚠️ Reranking failed: {e}")
+        return [c[:rerank_top_n] for c in candidates]
+
 if __name__ == "__main__":
     test_query = "forklar MOB funktionen"
     results = retrieve_and_rerank(test_query, top_k=10, rerank_top_n=3)
@@ -1,4 +1,5 @@
 import os
+import argparse
 import requests
 import json
 import time
@@ -6,6 +7,8 @@ import re
 from dotenv import load_dotenv
 from llama_index.core import Document
 from ingestion import ingest_documents
+from robustness import protected_request
+from profiling import profiled
 
 # Load environment variables
 load_dotenv(dotenv_path='/root/Buddy-RAG/.env')
@@ -23,8 +26,7 @@ def get_document_details(doc_id):
     print(f"📥 Fetching details for document ID {doc_id} from Paperless...")
     url = f"{PAPERLESS_URL}/api/documents/{doc_id}/"
     try:
-        res = requests.get(url, headers=PAPERLESS_HEADERS)
-        res.raise_for_status()
+        res = protected_request("paperless", "GET", url, headers=PAPERLESS_HEADERS)
         return res.json()
     except Exception as e:
         print(f"❌ Failed to fetch document details for ID {doc_id}: {e}")
@@ -34,8 +36,7 @@ def download_document(doc_id, original_filename):
     """Downloads a document from Paperless to a temp file."""
     url = f"{PAPERLESS_URL}/api/documents/{doc_id}/download/"
     try:
-        res = requests.get(url, headers=PAPERLESS_HEADERS, stream=True)
-        res.raise_for_status()
+        res = protected_request("paperless", "GET", url, headers=PAPERLESS_HEADERS, stream=True)
         
         temp_path = f"/tmp/{original_filename}"
         with open(temp_path, 'wb') as f:
@@ -55,8 +56,8 @@ def process_docling_async(file_path):
     
     try:
         print(f"🚀 Sending {os.path.basename(file_path)} to Docling...")
-        res = requests.post(submit_url, files=files, data=data)
-        res.raise_for_status()
+        # Not retried: a retry after a lost response would start a second conversion
+        res = protected_request("docling", "POST", submit_url, retries=0, timeout=300, files=files, data=data)
         task_id = res.json()['task_id']
     except Exception as e:
         print(f"❌ Docling upload failed: {e}")
@@ -68,13 +69,12 @@ def process_docling_async(file_path):
     start = time.time()
     while time.time() - start < 3600: # 60 min timeout
         try:
-            status_res = requests.get(poll_url)
-            status_res.raise_for_status()
+            status_res = protected_request("docling", "GET", poll_url, retries=0)
             status = status_res.json().get('task_status')
             
             if status == 'success':
                 print("✅ Docling processing complete.")
-                return requests.get(result_url).json()
+                return protected_request("docling", "GET", result_url, timeout=300).json()
             elif status == 'failure':
                 print(f"❌ Docling task failed. Full response: {requests.get(result_url).text}")
                 return None
@@ -142,4 +142,10 @@ def main(doc_id_to_process):
 
 if __name__ == "__main__":
     DOCUMENT_ID = 3
-    main(DOCUMENT_ID)
+    parser = argparse.ArgumentParser(description="Ingest one Paperless document.")
+    parser.add_argument("doc_id", nargs="?", type=int, default=DOCUMENT_ID, help=f"Paperless document id (default: {DOCUMENT_ID})")
+    parser.add_argument("--profile", action="store_true", help="Write a sampling profile (speedscope) of the run")
+    args = parser.parse_args()
+
+    with profiled(f"ingest-{args.doc_id}", enabled=args.profile):
+        main(args.doc_id)
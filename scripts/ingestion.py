@@ -1,13 +1,22 @@
 import os
 import json
+import uuid
+import hashlib
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient
 from llama_index.core import Document, Settings
-from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import TextNode, NodeRelationship
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.embeddings.ollama import OllamaEmbedding
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 from robustness import retry_with_backoff
+from lexical_index import build_lexical_index
+from retrieval_cache import bump_collection_version
+from parent_store import store_parents, delete_parents, PARENT_ID_KEY
+from ingestion_journal import IngestionJournal
+from markdown_chunker import MarkdownStructureChunker, DocumentBlocks, EMBED_MAX_TOKENS, EMBED_TOKENIZER
+from token_counting import get_token_counter
+from metadata_filters import payload_indexes, ensure_payload_indexes
 
 # Load environment variables
 load_dotenv()
@@ -18,6 +27,27 @@ QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION")
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL")
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL")
 
+# Parent sections go to the LLM; small child chunks are embedded and searched.
+# Sizes are exact token counts of the embedding tokenizer, metadata included,
+# so children never exceed nomic-embed-text's practical limit (see findings.md).
+PARENT_CHUNK_TOKENS = 1024
+CHILD_CHUNK_TOKENS = min(256, EMBED_MAX_TOKENS)
+
+# Child chunks per embedding/upsert batch; the unit of retry and resume
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+
+# Everything that decides chunk and batch boundaries. Part of each document's
+# journal key, so a resume never skips batches that were cut differently.
+CHUNKING_CONFIG = {
+    "tokenizer": EMBED_TOKENIZER,
+    "parent_tokens": PARENT_CHUNK_TOKENS,
+    "child_tokens": CHILD_CHUNK_TOKENS,
+    "batch_size": EMBED_BATCH_SIZE,
+}
+
+# Namespace for deterministic point ids, so a resumed run overwrites instead of duplicating
+POINT_ID_NAMESPACE = uuid.UUID("5d6f1c3e-8a43-4c1b-9b7e-2f0d7c1a9e42")
+
 def sanitize_metadata(documents: list[Document]) -> list[Document]:
     """
     Sanitizes metadata in documents to ensure Qdrant compatibility.
@@ -47,6 +77,97 @@ def sanitize_metadata(documents: list[Document]) -> list[Document]:
     
     return sanitized_docs
 
+def document_source_key(document: Document) -> str:
+    """Stable id of the source document, e.g. 'paperless:3'; content hash if unknown."""
+    if "doc_id" in document.metadata:
+        return f"{document.metadata.get('source', 'doc')}:{document.metadata['doc_id']}"
+    return "text:" + hashlib.sha256(document.text.encode("utf-8")).hexdigest()[:16]
+
+def document_key(document: Document) -> str:
+    """
+    Identifies one version of a document: its source, text and metadata,
+    and the chunking config it is cut with.
+    """
+    digest = hashlib.sha256()
+    digest.update(document.id_.encode("utf-8"))
+    digest.update(document.text.encode("utf-8"))
+    digest.update(json.dumps(document.metadata, sort_keys=True).encode("utf-8"))
+    digest.update(json.dumps(CHUNKING_CONFIG, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def point_id(doc_key: str, kind: str, index: int) -> str:
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{doc_key}:{kind}:{index}"))
+
+def iter_parent_child(document: Document, doc_key: str):
+    """
+    Streams (parent, children) pairs: Markdown-structure-aware parent sections,
+    each cut into child chunks. Children keep the original document as their
+    source and point at their parent via metadata.
+    Ids are derived from `doc_key` and position, so chunking the same document
+    version again yields the same point ids.
+    The Markdown is parsed once; each parent's children are cut from the
+    blocks inside its span.
+    """
+    blocks = DocumentBlocks(document)
+    parent_chunker = MarkdownStructureChunker(max_tokens=PARENT_CHUNK_TOKENS)
+    child_chunker = MarkdownStructureChunker(max_tokens=CHILD_CHUNK_TOKENS)
+
+    child_index = 0
+    for parent_index, parent in enumerate(parent_chunker.iter_chunks(document, blocks=blocks)):
+        parent.id_ = point_id(doc_key, "parent", parent_index)
+        children = []
+        for child in child_chunker.iter_chunks(
+            document, span=(parent.start_char_idx, parent.end_char_idx), blocks=blocks
+        ):
+            child.id_ = point_id(doc_key, "child", child_index)
+            child_index += 1
+            child.relationships[NodeRelationship.PARENT] = parent.as_related_node_info()
+            child.metadata[PARENT_ID_KEY] = parent.node_id
+            child.excluded_embed_metadata_keys.append(PARENT_ID_KEY)
+            child.excluded_llm_metadata_keys.append(PARENT_ID_KEY)
+            children.append(child)
+        yield parent, children
+
+def iter_batches(document: Document, doc_key: str):
+    """Groups whole parents (with their children) into batches of ~EMBED_BATCH_SIZE children."""
+    parents, children = [], []
+    for parent, parent_children in iter_parent_child(document, doc_key):
+        parents.append(parent)
+        children.extend(parent_children)
+        if len(children) >= EMBED_BATCH_SIZE:
+            yield parents, children
+            parents, children = [], []
+    if parents:
+        yield parents, children
+
+def delete_legacy_points(client: QdrantClient, document: Document):
+    """
+    Removes the points a source document got from the pre-journal pipeline:
+    flat 1024-token chunks with random `ref_doc_id`s and no parent, which
+    neither the journal nor `vector_store.delete(source_key)` can find.
+    They are matched on `source` and `filename`; children of the current
+    pipeline carry a parent id and are never matched.
+    """
+    source, filename = document.metadata.get("source"), document.metadata.get("filename")
+    if not (source and filename):
+        return
+    from qdrant_client import models
+
+    if not client.collection_exists(QDRANT_COLLECTION):
+        return
+    client.delete(
+        collection_name=QDRANT_COLLECTION,
+        points_selector=models.FilterSelector(
+            filter=models.Filter(
+                must=[
+                    models.FieldCondition(key="source", match=models.MatchValue(value=source)),
+                    models.FieldCondition(key="filename", match=models.MatchValue(value=filename)),
+                    models.IsEmptyCondition(is_empty=models.PayloadField(key=PARENT_ID_KEY)),
+                ]
+            )
+        ),
+    )
+
 def get_pipeline():
     """
     Creates and returns the LlamaIndex IngestionPipeline.
@@ -55,7 +176,12 @@ def get_pipeline():
     client = QdrantClient(url=QDRANT_URL)
     
     # 2. Initialize Vector Store
-    vector_store = QdrantVectorStore(client=client, collection_name=QDRANT_COLLECTION)
+    # Payload indexes back the metadata filters; a new collection gets them on
+    # creation, an existing one here
+    vector_store = QdrantVectorStore(
+        client=client, collection_name=QDRANT_COLLECTION, payload_indexes=payload_indexes()
+    )
+    ensure_payload_indexes(client, QDRANT_COLLECTION)
     
     # 3. Initialize Embedding Model (Ollama)
     embed_model = OllamaEmbedding(
@@ -63,9 +189,8 @@ def get_pipeline():
         base_url=OLLAMA_BASE_URL,
     )
 
-    # 4. Initialize Transformations
+    # 4. Initialize Transformations (chunking happens in iter_parent_child)
     transformations = [
-        SentenceSplitter(chunk_size=1024, chunk_overlap=20),
         embed_model,
     ]
 
@@ -78,22 +203,91 @@ def get_pipeline():
     return pipeline
 
 @retry_with_backoff(max_retries=3, initial_delay=2, backoff_factor=2)
+def ingest_batch(pipeline: IngestionPipeline, parents: list[TextNode], children: list[TextNode]):
+    """
+    Stores one batch: parent sections, then embedded child chunks.
+    Upserts with deterministic ids, so retrying a half-written batch is safe.
+    """
+    store_parents(parents)
+    return pipeline.run(nodes=children)
+
+def ingest_document(document: Document, pipeline: IngestionPipeline, journal: IngestionJournal) -> list[TextNode]:
+    """
+    Ingests one document batch by batch, recording progress in the journal.
+    Batches finished by an earlier (killed or failed) run are skipped.
+    """
+    source_key = document_source_key(document)
+    document.id_ = source_key
+    doc_key = document_key(document)
+
+    if journal.document_done(doc_key):
+        print(f"⏭️ {source_key} already ingested, skipping.")
+        return []
+
+    # Collections built before ingestion was journaled hold flat chunks the
+    # journal knows nothing about; they go before the first journaled ingest
+    if not journal.has_source(source_key):
+        print(f"🧽 Removing pre-journal chunks of {source_key}, if any...")
+        delete_legacy_points(pipeline.vector_store.client, document)
+
+    # A changed document replaces the points of its previous version
+    for old_key in journal.other_versions(source_key, doc_key):
+        print(f"🗑️ Removing previous version of {source_key}...")
+        pipeline.vector_store.delete(source_key)
+        delete_parents(source_key)
+        journal.forget(old_key)
+
+    journal.start_document(doc_key, source_key)
+
+    nodes = []
+    n_children = 0
+    for batch_no, (parents, children) in enumerate(iter_batches(document, doc_key)):
+        n_children += len(children)
+        if journal.batch_done(doc_key, batch_no):
+            continue
+        nodes.extend(ingest_batch(pipeline, parents, children))
+        journal.mark_batch(doc_key, batch_no, len(children))
+        print(f"📦 {source_key}: batch {batch_no + 1} done ({n_children} chunks so far).")
+
+    journal.finish_document(doc_key, n_children)
+    return nodes
+
 def ingest_documents(documents: list[Document]):
     """
     Ingests a list of LlamaIndex Document objects into the pipeline.
-    Sanitizes metadata first.
+    Sanitizes metadata first. Progress is journaled per document and batch;
+    a failed batch is retried on its own and a rerun resumes where it stopped.
     """
     print(f"🧹 Sanitizing metadata for {len(documents)} documents...")
     documents = sanitize_metadata(documents)
 
+    # Chunk sizing needs the embedding tokenizer; fail before any stored points are replaced
+    get_token_counter(EMBED_TOKENIZER, strict=True)
+
     pipeline = get_pipeline()
+    journal = IngestionJournal()
     
     print(f"🚀 Starting ingestion of {len(documents)} documents...")
     
-    # Run the pipeline
-    nodes = pipeline.run(documents=documents, show_progress=True)
-    
-    print(f"✅ Ingestion complete! Processed {len(nodes)} nodes.")
+    nodes = []
+    try:
+        for document in documents:
+            nodes.extend(ingest_document(document, pipeline, journal))
+    finally:
+        print(f"✅ Ingestion finished. Processed {len(nodes)} nodes in this run.")
+
+        # After any write, also when the run failed partway, a resume only had
+        # to mark a document done, or an old version was removed
+        if journal.changed:
+            # Swap in a new lexical index generation; API workers remap it on their next query
+            try:
+                build_lexical_index()
+            except Exception as e:
+                print(f"⚠️ Failed to rebuild lexical index: {e}")
+
+            # Invalidates cached retrieval candidates in every API worker
+            bump_collection_version()
+
     return nodes
 
 if __name__ == "__main__":
@@ -115,6 +309,9 @@ if __name__ == "__main__":
     try:
         nodes = ingest_documents([dummy_doc])
         print("🎉 Test passed: Metadata sanitized successfully.")
-        print("Sanitized Metadata:", nodes[0].metadata)
+        if nodes:
+            print("Sanitized Metadata:", nodes[0].metadata)
+        else:
+            print("(Already ingested according to the journal.)")
     except Exception as e:
         print(f"❌ Test failed: {e}")
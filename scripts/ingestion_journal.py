@@ -0,0 +1,95 @@
+import os
+import time
+import sqlite3
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+INGESTION_JOURNAL = os.getenv(
+    "INGESTION_JOURNAL",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "ingestion_journal.sqlite3"),
+)
+
+class IngestionJournal:
+    """
+    Local SQLite journal of ingestion progress, per document and per batch.
+
+    A document is identified by `doc_key` (hash of its source and content), so a
+    changed document is a new key. `source_key` groups the versions of one source
+    document, which lets ingestion replace an old version's points.
+    `changed` is set once this instance records a written batch, a finished
+    document or a forgotten one, i.e. when the stored points changed and
+    derived indexes need a rebuild.
+    """
+    def __init__(self, path: str = INGESTION_JOURNAL):
+        self.changed = False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_key TEXT PRIMARY KEY,
+                source_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                n_nodes INTEGER,
+                updated_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                doc_key TEXT NOT NULL,
+                batch_no INTEGER NOT NULL,
+                n_nodes INTEGER,
+                updated_at REAL,
+                PRIMARY KEY (doc_key, batch_no)
+            );
+        """)
+        self.conn.commit()
+
+    def document_done(self, doc_key: str) -> bool:
+        row = self.conn.execute("SELECT status FROM documents WHERE doc_key = ?", (doc_key,)).fetchone()
+        return row is not None and row[0] == "done"
+
+    def has_source(self, source_key: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM documents WHERE source_key = ?", (source_key,)).fetchone()
+        return row is not None
+
+    def other_versions(self, source_key: str, doc_key: str) -> list[str]:
+        rows = self.conn.execute(
+            "SELECT doc_key FROM documents WHERE source_key = ? AND doc_key != ?", (source_key, doc_key)
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def start_document(self, doc_key: str, source_key: str):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO documents (doc_key, source_key, status, updated_at) VALUES (?, ?, 'in_progress', ?)",
+            (doc_key, source_key, time.time()),
+        )
+        self.conn.commit()
+
+    def batch_done(self, doc_key: str, batch_no: int) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM batches WHERE doc_key = ? AND batch_no = ?", (doc_key, batch_no)
+        ).fetchone()
+        return row is not None
+
+    def mark_batch(self, doc_key: str, batch_no: int, n_nodes: int):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO batches (doc_key, batch_no, n_nodes, updated_at) VALUES (?, ?, ?, ?)",
+            (doc_key, batch_no, n_nodes, time.time()),
+        )
+        self.conn.commit()
+        self.changed = True
+
+    def finish_document(self, doc_key: str, n_nodes: int):
+        self.conn.execute(
+            "UPDATE documents SET status = 'done', n_nodes = ?, updated_at = ? WHERE doc_key = ?",
+            (n_nodes, time.time(), doc_key),
+        )
+        self.conn.commit()
+        self.changed = True
+
+    def forget(self, doc_key: str):
+        self.conn.execute("DELETE FROM batches WHERE doc_key = ?", (doc_key,))
+        self.conn.execute("DELETE FROM documents WHERE doc_key = ?", (doc_key,))
+        self.conn.commit()
+        self.changed = True
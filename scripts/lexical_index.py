@@ -0,0 +1,376 @@
+import os
+import json
+import mmap
+import time
+import fcntl
+import shutil
+import threading
+import numpy as np
+import bm25s
+from typing import TYPE_CHECKING
+from dotenv import load_dotenv
+from llama_index.core import QueryBundle
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import TextNode, NodeWithScore, NodeRelationship, RelatedNodeInfo
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from metadata_filters import SearchFilters, active_filters, parse_created
+from retrieval_cache import LRUCache
+
+# Only building a generation talks to Qdrant; serving just maps files
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION")
+LEXICAL_INDEX_DIR = os.getenv(
+    "LEXICAL_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "lexical_index"),
+)
+KEEP_GENERATIONS = 2
+STOPWORDS = "en"
+FILTER_MASK_CACHE_SIZE = 64
+
+CURRENT_LINK = "current"
+NODES_FILE = "nodes.jsonl"
+OFFSETS_FILE = "nodes.offsets.npy"
+FILTERS_FILE = "filters.json"
+BITMAPS_FILE = "filters.bitmaps.npy"
+CREATED_FILE = "filters.created.npy"
+
+# Metadata fields with a precomputed bitmap per value
+BITMAP_FIELDS = ("ref_doc_id", "source", "tags")
+
+def payload_record(point_id, payload: dict) -> dict:
+    """
+    Converts a Qdrant point payload written by LlamaIndex into a node store record.
+    The serialized node carries the original metadata, its exclusion lists
+    and char offsets; the flat payload duplicates the text and overwrites `doc_id`.
+    """
+    try:
+        node = metadata_dict_to_node(payload)
+        return {
+            "id": str(point_id),
+            "text": node.get_content(),
+            "metadata": node.metadata,
+            "ref_doc_id": node.ref_doc_id,
+            "start": node.start_char_idx,
+            "end": node.end_char_idx,
+            "excluded_embed_metadata_keys": node.excluded_embed_metadata_keys,
+            "excluded_llm_metadata_keys": node.excluded_llm_metadata_keys,
+        }
+    except ValueError:
+        metadata = {k: v for k, v in payload.items() if k != "text"}
+        return {"id": str(point_id), "text": payload.get("text", ""), "metadata": metadata,
+                "ref_doc_id": None, "start": None, "end": None,
+                "excluded_embed_metadata_keys": [], "excluded_llm_metadata_keys": []}
+
+def fetch_corpus(client: "QdrantClient"):
+    """Yields a node store record for every point in the collection."""
+    offset = None
+    while True:
+        points, next_offset = client.scroll(
+            collection_name=QDRANT_COLLECTION,
+            limit=256,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False
+        )
+        for point in points:
+            payload = point.payload if isinstance(point.payload, dict) else {}
+            yield payload_record(point.id, payload)
+
+        offset = next_offset
+        if offset is None:
+            break
+
+class NodeStore:
+    """
+    Read-only node text store backed by a memory-mapped JSONL file.
+    Row `i` matches document `i` of the BM25 index in the same generation.
+    """
+    def __init__(self, path: str):
+        self._file = open(os.path.join(path, NODES_FILE), "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def record(self, idx: int) -> dict:
+        start, end = int(self._offsets[idx]), int(self._offsets[idx + 1])
+        return json.loads(self._mm[start:end])
+
+    def get(self, idx: int) -> TextNode:
+        record = self.record(idx)
+        node = TextNode(
+            id_=record["id"],
+            text=record["text"],
+            metadata=record["metadata"],
+            start_char_idx=record["start"],
+            end_char_idx=record["end"],
+            # Absent from generations written before they were stored
+            excluded_embed_metadata_keys=record.get("excluded_embed_metadata_keys", []),
+            excluded_llm_metadata_keys=record.get("excluded_llm_metadata_keys", []),
+        )
+        if record["ref_doc_id"]:
+            node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=record["ref_doc_id"])
+        return node
+
+def _filter_values(record: dict):
+    """Yields the (field, value) pairs of a record that filters can select on."""
+    if record["ref_doc_id"]:
+        yield "ref_doc_id", record["ref_doc_id"]
+    metadata = record["metadata"]
+    if metadata.get("source"):
+        yield "source", metadata["source"]
+    tags = metadata.get("tags")
+    for tag in tags if isinstance(tags, list) else []:
+        yield "tags", tag
+
+def build_filter_columns(records) -> tuple[dict, np.ndarray, np.ndarray]:
+    """
+    Precomputes, for every filterable value, a packed bitmap of the documents
+    having it, plus the `created` timestamp of every document (NaN if unknown).
+    Returns (value -> bitmap row per field, packed bitmaps, created).
+    """
+    rows_by_value = {field: {} for field in BITMAP_FIELDS}
+    created = []
+    for i, record in enumerate(records):
+        for field, value in _filter_values(record):
+            rows_by_value[field].setdefault(str(value), []).append(i)
+        ts = parse_created(record["metadata"].get("created"))
+        created.append(np.nan if ts is None else ts)
+
+    n_docs = len(created)
+    index = {field: {} for field in BITMAP_FIELDS}
+    bitmaps = []
+    for field, values in rows_by_value.items():
+        for value, rows in values.items():
+            mask = np.zeros(n_docs, dtype=bool)
+            mask[rows] = True
+            index[field][value] = len(bitmaps)
+            bitmaps.append(np.packbits(mask))
+
+    packed = np.stack(bitmaps) if bitmaps else np.zeros((0, (n_docs + 7) // 8), dtype=np.uint8)
+    return index, packed, np.asarray(created, dtype=np.float64)
+
+class FilterBitmaps:
+    """
+    Turns SearchFilters into a BM25 weight mask by OR-ing and AND-ing the
+    precomputed per-value bitmaps, so filtered-out documents are never scored
+    above zero. Masks are cached per filter.
+    """
+    def __init__(self, index: dict, bitmaps: np.ndarray, created: np.ndarray):
+        self.index = index
+        self.bitmaps = bitmaps
+        self.created = created
+        self.n_docs = len(created)
+        self._masks = LRUCache(FILTER_MASK_CACHE_SIZE)
+
+    @classmethod
+    def load(cls, path: str, nodes: NodeStore) -> "FilterBitmaps":
+        try:
+            with open(os.path.join(path, FILTERS_FILE)) as f:
+                index = json.load(f)
+            bitmaps = np.load(os.path.join(path, BITMAPS_FILE), mmap_mode="r")
+            created = np.load(os.path.join(path, CREATED_FILE), mmap_mode="r")
+        except FileNotFoundError:
+            # Generation built before filter support: compute in memory
+            index, bitmaps, created = build_filter_columns(nodes.record(i) for i in range(len(nodes)))
+        return cls(index, bitmaps, created)
+
+    def _any(self, field: str, values) -> np.ndarray:
+        rows = [self.index[field][str(v)] for v in values if str(v) in self.index[field]]
+        if not rows:
+            return np.zeros(self.n_docs, dtype=bool)
+        packed = np.bitwise_or.reduce(self.bitmaps[rows], axis=0)
+        return np.unpackbits(packed, count=self.n_docs).astype(bool)
+
+    def mask(self, filters: SearchFilters) -> np.ndarray:
+        key = repr(filters)
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask
+
+        selected = np.ones(self.n_docs, dtype=bool)
+        if filters.documents:
+            selected &= self._any("ref_doc_id", filters.document_keys())
+        if filters.source:
+            selected &= self._any("source", [filters.source])
+        if filters.tags:
+            selected &= self._any("tags", filters.tags)
+        start, end = filters.created_range()
+        # NaN compares False, so documents without a date are excluded by date filters
+        if start:
+            selected &= self.created >= start.timestamp()
+        if end:
+            selected &= self.created < end.timestamp()
+
+        mask = selected.astype(np.float32)
+        self._masks.put(key, mask)
+        return mask
+
+class LexicalIndex:
+    """
+    One immutable generation of the BM25 index plus its node store.
+    All arrays are opened with mmap, so worker processes share them via the page cache.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.generation = os.path.basename(path)
+        self.bm25 = bm25s.BM25.load(path, mmap=True, show_progress=False)
+        self.nodes = NodeStore(path)
+        self.filters = FilterBitmaps.load(path, self.nodes)
+
+    def search(self, query_str: str, top_k: int, filters: SearchFilters | None = None) -> list[NodeWithScore]:
+        return self.search_batch([query_str], top_k, filters)[0]
+
+    def search_batch(self, queries: list[str], top_k: int, filters: SearchFilters | None = None) -> list[list[NodeWithScore]]:
+        """
+        Scores all queries against the index in a single BM25 pass.
+        Filters are applied as a weight mask before top-k selection.
+        """
+        weight_mask = None
+        filters = active_filters(filters)
+        if filters is not None:
+            weight_mask = self.filters.mask(filters)
+            if not weight_mask.any():
+                return [[] for _ in queries]
+
+        k = min(top_k, len(self.nodes))
+        if k <= 0:
+            return [[] for _ in queries]
+        query_tokens = bm25s.tokenize(queries, stopwords=STOPWORDS, return_ids=False, show_progress=False)
+        indexes, scores = self.bm25.retrieve(query_tokens, k=k, show_progress=False, weight_mask=weight_mask)
+
+        results = []
+        for row_indexes, row_scores in zip(indexes, scores):
+            nodes = []
+            for idx, score in zip(row_indexes, row_scores):
+                if score <= 0:
+                    continue
+                nodes.append(NodeWithScore(node=self.nodes.get(int(idx)), score=float(score)))
+            results.append(nodes)
+        return results
+
+def current_generation() -> str | None:
+    try:
+        return os.readlink(os.path.join(LEXICAL_INDEX_DIR, CURRENT_LINK))
+    except FileNotFoundError:
+        return None
+
+def _write_generation(client: "QdrantClient", gen_dir: str) -> int:
+    os.makedirs(gen_dir)
+    texts = []
+    offsets = [0]
+    filter_records = []
+    with open(os.path.join(gen_dir, NODES_FILE), "wb") as f:
+        for record in fetch_corpus(client):
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+            texts.append(record["text"])
+            filter_records.append({"ref_doc_id": record["ref_doc_id"], "metadata": record["metadata"]})
+
+    if not texts:
+        raise ValueError(f"Collection '{QDRANT_COLLECTION}' is empty.")
+
+    np.save(os.path.join(gen_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.uint64))
+
+    index, bitmaps, created = build_filter_columns(filter_records)
+    with open(os.path.join(gen_dir, FILTERS_FILE), "w") as f:
+        json.dump(index, f)
+    np.save(os.path.join(gen_dir, BITMAPS_FILE), bitmaps)
+    np.save(os.path.join(gen_dir, CREATED_FILE), created)
+
+    corpus_tokens = bm25s.tokenize(texts, stopwords=STOPWORDS, show_progress=False)
+    retriever = bm25s.BM25()
+    retriever.index(corpus_tokens, show_progress=False)
+    retriever.save(gen_dir, show_progress=False)
+    return len(texts)
+
+def _swap_current(generation: str):
+    """Atomically points `current` at a new generation (rename of a symlink)."""
+    tmp_link = os.path.join(LEXICAL_INDEX_DIR, f".{CURRENT_LINK}.{os.getpid()}")
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(generation, tmp_link)
+    os.replace(tmp_link, os.path.join(LEXICAL_INDEX_DIR, CURRENT_LINK))
+
+def _prune_generations(keep: int = KEEP_GENERATIONS):
+    # Workers still mapping an old generation keep their pages after unlink.
+    generations = sorted(d for d in os.listdir(LEXICAL_INDEX_DIR) if d.startswith("gen-"))
+    current = current_generation()
+    for generation in generations[:-keep]:
+        if generation != current:
+            shutil.rmtree(os.path.join(LEXICAL_INDEX_DIR, generation), ignore_errors=True)
+
+def build_lexical_index(only_if_missing: bool = False) -> str:
+    """
+    Builds a new index generation from Qdrant and swaps it in atomically.
+    Serialized across processes with a file lock, so N workers starting
+    at once build the index only once.
+    """
+    os.makedirs(LEXICAL_INDEX_DIR, exist_ok=True)
+    with open(os.path.join(LEXICAL_INDEX_DIR, ".build.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if only_if_missing and current_generation() is not None:
+                return current_generation()
+
+            generation = f"gen-{time.time_ns()}"
+            tmp_dir = os.path.join(LEXICAL_INDEX_DIR, f".{generation}.tmp")
+            print(f"⏳ Building lexical index generation {generation} (fetching docs from Qdrant)...")
+            try:
+                from qdrant_client import QdrantClient
+                count = _write_generation(QdrantClient(url=QDRANT_URL), tmp_dir)
+            except Exception:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+
+            os.rename(tmp_dir, os.path.join(LEXICAL_INDEX_DIR, generation))
+            _swap_current(generation)
+            _prune_generations()
+            print(f"📄 Indexed {count} nodes for BM25 ({generation}).")
+            return generation
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_lexical_index() -> LexicalIndex:
+    """
+    Returns the process-wide index, remapping when ingestion has swapped in
+    a new generation. Builds the first generation if none exists yet.
+    """
+    global _index
+    generation = current_generation()
+    if generation is None:
+        generation = build_lexical_index(only_if_missing=True)
+
+    if _index is None or _index.generation != generation:
+        with _index_lock:
+            if _index is None or _index.generation != generation:
+                _index = LexicalIndex(os.path.join(LEXICAL_INDEX_DIR, generation))
+                print(f"📚 Mapped lexical index {generation} ({len(_index.nodes)} nodes).")
+    return _index
+
+class LexicalRetriever(BaseRetriever):
+    """
+    BM25 retriever over the shared, memory-mapped lexical index.
+    """
+    def __init__(self, similarity_top_k: int = 5, filters: SearchFilters | None = None):
+        self.similarity_top_k = similarity_top_k
+        self.filters = filters
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        return get_lexical_index().search(query_bundle.query_str, self.similarity_top_k, self.filters)
+
+if __name__ == "__main__":
+    build_lexical_index()
@@ -0,0 +1,162 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import requests
+from dotenv import load_dotenv
+from robustness import DeadlineExceeded, time_remaining, get_breaker
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 2))
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")
+LLM_CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", 4096))
+LLM_REQUEST_TIMEOUT = 120.0
+
+# Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+class LLMGateway:
+    """
+    Single entry point for Ollama completions in this process.
+
+    - At most `max_concurrency` requests reach Ollama at once
+    - Waiting requests are served by priority, FIFO within a priority
+    - One Ollama client config (num_ctx, keep_alive) for every caller, so
+      Ollama never reloads the model and can reuse its prompt-prefix cache
+    - Queue wait and generation are bounded by the caller's deadline, and
+      calls go through the "ollama-llm" circuit breaker
+    """
+    def __init__(self, model: str, max_concurrency: int = LLM_MAX_CONCURRENCY, keep_alive: str = LLM_KEEP_ALIVE):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.keep_alive = keep_alive
+
+        # Imported here so importing the gateway module stays cheap
+        from llama_index.llms.ollama import Ollama
+
+        self.llm = Ollama(
+            model=model,
+            base_url=OLLAMA_BASE_URL,
+            request_timeout=LLM_REQUEST_TIMEOUT,
+            context_window=LLM_CONTEXT_WINDOW,
+            keep_alive=keep_alive,
+            additional_kwargs={"num_ctx": LLM_CONTEXT_WINDOW}
+        )
+
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._completed = 0
+        self._waits = deque(maxlen=1000)
+        self._timed_out = 0
+        # Completions run here so the caller can stop waiting at its deadline
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._breaker = get_breaker("ollama-llm")
+
+    def _acquire(self, priority: int):
+        ticket = (priority, next(self._seq))
+        start = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while self._in_flight >= self.max_concurrency or self._waiting[0] != ticket:
+                remaining = time_remaining()
+                if remaining is not None and remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._timed_out += 1
+                    self._cond.notify_all()
+                    raise DeadlineExceeded("Deadline exceeded while queued for the LLM.")
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            self._waits.append(time.monotonic() - start)
+            # The next ticket in line may fit in the remaining capacity
+            self._cond.notify_all()
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._completed += 1
+            self._cond.notify_all()
+
+    def complete(self, prompt: str, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Queues and runs a completion. Blocks the calling thread until done,
+        or raises DeadlineExceeded when the current deadline runs out first.
+        """
+        self._acquire(priority)
+        try:
+            future = self._executor.submit(self._breaker.call, self.llm.complete, prompt)
+        except BaseException:
+            self._release()
+            raise
+        # Ollama keeps generating after we give up, so the slot is freed only
+        # when the call really ends; that keeps the concurrency bound honest
+        future.add_done_callback(lambda _: self._release())
+        try:
+            return future.result(timeout=time_remaining())
+        except FutureTimeout:
+            with self._cond:
+                self._timed_out += 1
+            raise DeadlineExceeded("Deadline exceeded during LLM generation.") from None
+
+    def warm_up(self):
+        """
+        Loads the model into Ollama memory with our num_ctx and keep_alive,
+        so the first real query does not pay the model load.
+        """
+        print(f"🔥 Warming up LLM: {self.model} (keep_alive={self.keep_alive})...")
+        res = requests.post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={
+                "model": self.model,
+                "keep_alive": self.keep_alive,
+                "options": {"num_ctx": LLM_CONTEXT_WINDOW},
+            },
+            timeout=LLM_REQUEST_TIMEOUT,
+        )
+        res.raise_for_status()
+
+    def stats(self) -> dict:
+        with self._cond:
+            waits = sorted(self._waits)
+            queued = {}
+            for priority, _ in self._waiting:
+                queued[priority] = queued.get(priority, 0) + 1
+            stats = {
+                "model": self.model,
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._in_flight,
+                "queue_depth": len(self._waiting),
+                "queue_depth_by_priority": queued,
+                "completed": self._completed,
+                "timed_out": self._timed_out,
+            }
+
+        if waits:
+            stats["wait_ms"] = {
+                "mean": round(1000 * sum(waits) / len(waits), 1),
+                "p50": round(1000 * waits[len(waits) // 2], 1),
+                "p95": round(1000 * waits[min(len(waits) - 1, int(len(waits) * 0.95))], 1),
+                "max": round(1000 * waits[-1], 1),
+            }
+        return stats
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+def get_gateway(model: str) -> LLMGateway:
+    """Returns the process-wide gateway for a model."""
+    with _gateways_lock:
+        if model not in _gateways:
+            _gateways[model] = LLMGateway(model)
+        return _gateways[model]
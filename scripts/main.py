@@ -1,19 +1,29 @@
 import os
+import time
 import uvicorn
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from qdrant_client import QdrantClient
 
 # Importer LlamaIndex komponenter
-from llama_index.core import VectorStoreIndex, Settings, PromptTemplate
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.llms.ollama import Ollama
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.core.postprocessor import SentenceTransformerRerank
+from llama_index.core import Settings, PromptTemplate, QueryBundle
 
 # Importer vores custom hybrid retriever
-from hybrid_retrieval import HybridRetriever, get_hybrid_retriever
+from hybrid_retrieval import (
+    get_hybrid_retriever, get_embed_model, load_reranker, batch_retrieve_and_rerank, apply_filters
+)
+from context_packing import assemble_context, context_budget
+from llm_gateway import get_gateway, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from retrieval_cache import cache_stats
+from parent_store import expand_to_parents
+from metadata_filters import SearchFilters
+from profiling import request_profile, header_requests_profile, PROFILE_HEADER
+from robustness import deadline, check_deadline, DeadlineExceeded, CircuitOpenError, breaker_stats
 
 # Indlæs konfiguration
 load_dotenv()
@@ -24,10 +34,25 @@ QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION")
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL")
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL")
 LLM_MODEL_NAME = os.getenv("LLM_MODEL", "llama3.2:latest")
+RETRIEVAL_TOP_K = 20  # broad net before reranking
+RERANK_TOP_N = 5  # chunks considered for the final answer
+QUERY_DEADLINE_S = float(os.getenv("QUERY_DEADLINE_S", 60))  # budget for retrieval -> rerank -> generate
+BATCH_DEADLINE_S = float(os.getenv("BATCH_DEADLINE_S", 600))
+
+# Custom prompt to ensure Danish answers
+QA_PROMPT_TMPL = (
+    "Du er en hjælpsom assistent. Svar på spørgsmålet baseret på nedenstående kontekst.\n"
+    "Hvis svaret ikke findes i konteksten, så sig det.\n"
+    "Svar kort og præcist på Dansk.\n\n"
+    "Kontekst:\n---------------------\n{context_str}\n---------------------\n\n"
+    "Spørgsmål: {query_str}\nSvar:"
+)
+qa_prompt = PromptTemplate(QA_PROMPT_TMPL)
 
 # --- Pydantic Modeller ---
 class QueryRequest(BaseModel):
     query: str
+    filters: SearchFilters | None = None
 
 class SourceNode(BaseModel):
     file_name: str
@@ -38,95 +63,254 @@ class SourceNode(BaseModel):
 class QueryResponse(BaseModel):
     response: str
     sources: list[SourceNode] = []
+    error: str | None = None  # set on a failed batch item; the other items are still answered
+
+class BatchQueryRequest(BaseModel):
+    queries: list[str]
+    filters: SearchFilters | None = None  # applied to every query
+
+class BatchQueryResponse(BaseModel):
+    results: list[QueryResponse]
 
 # --- Initialisering ---
 app = FastAPI(title="Buddy RAG API", description="Persistent RAG Service with Hybrid Search & Reranking")
 
 # Globals
-query_engine = None
+retriever = None
 reranker = None
+gateway = None
 
-@app.on_event("startup")
-def startup_event():
-    global query_engine, reranker
-    print("🚀 Starting Buddy RAG API...")
-    
-    # 1. Setup Models
+# Startup state: /healthz answers at once, /readyz and the query endpoints
+# only once every component below is loaded
+ready = threading.Event()
+startup_errors = {}
+startup_timings = {}
+
+def load_llm():
+    global gateway
     print(f"🧠 Loading LLM: {LLM_MODEL_NAME} (Context: 4096)...")
-    Settings.llm = Ollama(
-        model=LLM_MODEL_NAME, 
-        base_url=OLLAMA_BASE_URL,
-        request_timeout=120.0,
-        context_window=4096,
-        additional_kwargs={"num_ctx": 4096}
-    )
-    
+    gateway = get_gateway(LLM_MODEL_NAME)
+    Settings.llm = gateway.llm
+    try:
+        gateway.warm_up()
+    except Exception as e:
+        print(f"⚠️ LLM warm-up failed: {e}")
+
+def load_embeddings():
     print(f"🧬 Loading Embeddings: {EMBED_MODEL_NAME}...")
+    embed_model = get_embed_model()
+    # Loads the embedding model into Ollama before the first query needs it
+    try:
+        embed_model.get_query_embedding("warm-up")
+    except Exception as e:
+        print(f"⚠️ Embedding warm-up failed: {e}")
 
-    Settings.embed_model = OllamaEmbedding(
-        model_name=EMBED_MODEL_NAME, 
-        base_url=OLLAMA_BASE_URL
-    )
-    
-    # 2. Load Reranker into Memory (This is the heavy lift we do ONCE)
-    print("⚖️  Loading Reranker Model (BAAI/bge-reranker-v2-m3)...")
-    reranker = SentenceTransformerRerank(
-        model="BAAI/bge-reranker-v2-m3", 
-        top_n=5, # We take top 5 chunks for the final answer
-        device="cpu"
-    )
-    
-    # 3. Setup Retriever
+def load_reranker_model():
+    # The heavy lift we do ONCE; from the local snapshot after the first start
+    global reranker
+    reranker = load_reranker(RERANK_TOP_N)
+
+def load_retriever():
+    # Maps the lexical index generation already on disk; builds one only if none exists
+    global retriever
     print("🔍 Initializing Hybrid Retriever...")
-    # top_k=20 fetches a broad net before reranking
-    retriever = get_hybrid_retriever(top_k=20)
-    
-    # 4. Create Query Engine
-    print("⚙️  Assembling Query Engine...")
-    query_engine = VectorStoreIndex.from_vector_store(
-        vector_store=QdrantVectorStore(
-            client=QdrantClient(url=QDRANT_URL), 
-            collection_name=QDRANT_COLLECTION
-        )
-    ).as_query_engine(
-        llm=Settings.llm,
-        node_postprocessors=[reranker],
-        response_mode="compact"
-    )
-    print("✅ System Ready!")
+    retriever = get_hybrid_retriever(top_k=RETRIEVAL_TOP_K)
 
-@app.post("/query", response_model=QueryResponse)
-async def query_index(request: QueryRequest):
+def load_components():
+    """Loads the independent components concurrently, then marks the service ready."""
+    start = time.monotonic()
+    loaders = {
+        "llm": load_llm,
+        "embeddings": load_embeddings,
+        "reranker": load_reranker_model,
+        "retriever": load_retriever,
+    }
+
+    def timed(name, loader):
+        t0 = time.monotonic()
+        try:
+            loader()
+        finally:
+            startup_timings[name] = round(time.monotonic() - t0, 2)
+
+    with ThreadPoolExecutor(max_workers=len(loaders), thread_name_prefix="startup") as pool:
+        futures = {name: pool.submit(timed, name, loader) for name, loader in loaders.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"❌ Failed to load {name}: {e}")
+                startup_errors[name] = str(e)
+
+    startup_timings["total"] = round(time.monotonic() - start, 2)
+    if startup_errors:
+        print(f"❌ Startup failed after {startup_timings['total']}s; /readyz stays 503.")
+        return
+    ready.set()
+    print(f"✅ System Ready! ({startup_timings['total']}s)")
+
+@app.on_event("startup")
+def startup_event():
+    print("🚀 Starting Buddy RAG API...")
+    # Loading runs in the background so the server accepts connections (and
+    # answers /healthz) right away; traffic is routed once /readyz says so
+    threading.Thread(target=load_components, name="startup", daemon=True).start()
+
+def require_ready():
+    if not ready.is_set():
+        raise HTTPException(status_code=503, detail="Service is starting up.")
+
+def answer_from_nodes(query: str, nodes, priority: int) -> QueryResponse:
     """
-    FastAPI endpoint that uses the pre-loaded engine.
+    Expands the reranked child chunks to their parent sections, packs them
+    into one context and makes exactly one LLM call.
     """
-    print(f"📨 Received query: {request.query}")
-    
-    # Custom prompt to ensure Danish answers
-    QA_PROMPT = (
-        "Du er en hjælpsom assistent. Svar på spørgsmålet baseret på nedenstående kontekst.\n"
-        "Hvis svaret ikke findes i konteksten, så sig det.\n"
-        "Svar kort og præcist på Dansk.\n\n"
-        "Kontekst:\n---------------------\n{context_str}\n---------------------\n\n"
-        "Spørgsmål: {query_str}\nSvar:"
+    nodes = expand_to_parents(nodes)
+    context_str, passages = assemble_context(nodes, context_budget(QA_PROMPT_TMPL, query))
+    if not passages:
+        return QueryResponse(response="Jeg kunne ikke finde information om dette i databasen.")
+    print(f"📄 Packed {len(passages)} passages into context.")
+
+    response = gateway.complete(
+        qa_prompt.format(context_str=context_str, query_str=query),
+        priority=priority
     )
-    
-    # Update prompt for this specific query
-    query_engine.update_prompts({"response_synthesizer:text_qa_template": PromptTemplate(QA_PROMPT)})
-    
-    response = query_engine.query(request.query)
-    
+
     sources = []
-    for node in response.source_nodes:
-        meta = node.metadata
+    for node in passages:
+        meta = node.node.metadata
         sources.append(SourceNode(
             file_name=meta.get("file_name", "N/A"),
             page_label=meta.get("page_label"),
-            text_snippet=node.get_content()[:200] + "...",
+            text_snippet=node.node.get_content()[:200] + "...",
             score=node.score
         ))
 
     return QueryResponse(response=str(response), sources=sources)
 
+def answer_batch_item(query: str, nodes) -> QueryResponse:
+    """
+    One question of a batch. A failed LLM call (deadline, open circuit,
+    Ollama error) is reported on its item instead of failing the batch.
+    """
+    try:
+        return answer_from_nodes(query, nodes, PRIORITY_BATCH)
+    except Exception as e:
+        print(f"❌ Batch query failed: '{query}': {e}")
+        return QueryResponse(response="", error=f"{type(e).__name__}: {e}")
+
+@contextmanager
+def service_errors():
+    """Maps an exhausted deadline to 504 and an open circuit to 503."""
+    try:
+        yield
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def set_profile_header(response: Response, profile):
+    if profile is not None and profile.path:
+        response.headers["X-Profile-Path"] = profile.path
+
+# Sync endpoints: FastAPI runs them in its threadpool, so waiting in the
+# LLM queue does not block the event loop
+@app.post("/query", response_model=QueryResponse)
+def query_index(request: QueryRequest, response: Response, x_profile: str | None = Header(default=None, alias=PROFILE_HEADER)):
+    """
+    FastAPI endpoint that uses the pre-loaded retriever and reranker.
+    Context is packed to a fixed token budget, so every query is one LLM call.
+    With an `X-Profile: 1` header the request is profiled; the profile's
+    path is returned in the `X-Profile-Path` response header.
+    """
+    require_ready()
+    print(f"📨 Received query: {request.query}")
+
+    with request_profile("query", header_requests_profile(x_profile)) as profile:
+        with deadline(QUERY_DEADLINE_S), service_errors():
+            query_bundle = QueryBundle(query_str=request.query)
+            nodes = apply_filters(retriever, request.filters).retrieve(query_bundle)
+            check_deadline("rerank")
+            nodes = reranker.postprocess_nodes(nodes, query_bundle)
+
+            result = answer_from_nodes(request.query, nodes, PRIORITY_INTERACTIVE)
+
+    set_profile_header(response, profile)
+    return result
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+def query_batch(request: BatchQueryRequest, response: Response, x_profile: str | None = Header(default=None, alias=PROFILE_HEADER)):
+    """
+    Answers many questions at once. Embedding, vector search, BM25 and
+    reranking run batched; the LLM calls fan out at batch priority.
+    A question whose answer fails gets an `error` instead of failing the batch.
+    """
+    require_ready()
+    print(f"📨 Received batch of {len(request.queries)} queries")
+    if not request.queries:
+        return BatchQueryResponse(results=[])
+
+    with request_profile("query-batch", header_requests_profile(x_profile)) as profile:
+        with deadline(BATCH_DEADLINE_S), service_errors():
+            ranked = batch_retrieve_and_rerank(
+                request.queries, top_k=RETRIEVAL_TOP_K, rerank_top_n=RERANK_TOP_N, reranker=reranker,
+                filters=request.filters
+            )
+
+            # Worker threads start with an empty context; give each task a copy of
+            # ours so the batch deadline applies to its LLM call too
+            with ThreadPoolExecutor(max_workers=gateway.max_concurrency) as pool:
+                futures = [
+                    pool.submit(contextvars.copy_context().run, answer_batch_item, query, nodes)
+                    for query, nodes in zip(request.queries, ranked)
+                ]
+                results = [f.result() for f in futures]
+
+    set_profile_header(response, profile)
+    return BatchQueryResponse(results=results)
+
+@app.get("/metrics/llm")
+def llm_metrics():
+    """
+    LLM queue depth, in-flight requests and recent queue wait times.
+    """
+    require_ready()
+    return gateway.stats()
+
+@app.get("/healthz")
+def healthz():
+    """
+    Liveness: the process is up and serving HTTP, warm or not.
+    """
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    """
+    Readiness: 200 once the LLM, embeddings, reranker and retriever are
+    loaded, 503 while starting or after a failed startup.
+    """
+    if ready.is_set():
+        return {"status": "ready", "startup_s": startup_timings}
+    status = "failed" if startup_errors else "starting"
+    return JSONResponse(
+        status_code=503,
+        content={"status": status, "startup_s": startup_timings, "errors": startup_errors},
+    )
+
+@app.get("/metrics/breakers")
+def breaker_metrics():
+    """
+    State of the circuit breakers for Qdrant, Ollama and the ingestion services.
+    """
+    return breaker_stats()
+
+@app.get("/metrics/retrieval")
+def retrieval_metrics():
+    """
+    Hit rates of the query-embedding and retrieval candidate caches.
+    """
+    return cache_stats()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
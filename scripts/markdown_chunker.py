@@ -0,0 +1,381 @@
+import os
+import re
+from bisect import bisect_right
+from typing import Any, Iterator, List, Sequence
+from dotenv import load_dotenv
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.node_parser import NodeParser
+from llama_index.core.schema import BaseNode, TextNode, MetadataMode, NodeRelationship
+from token_counting import get_token_counter
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+# Hugging Face tokenizer of the embedding model; nomic-embed-text uses a BERT vocabulary.
+# Loaded strictly (needs `transformers`): there is no fallback, as counts in another
+# vocabulary would let chunks exceed EMBED_MAX_TOKENS.
+EMBED_TOKENIZER = os.getenv("EMBED_TOKENIZER", "nomic-ai/nomic-embed-text-v1.5")
+# Practical input limit of nomic-embed-text (see findings.md)
+EMBED_MAX_TOKENS = int(os.getenv("EMBED_MAX_TOKENS", 512))
+SPECIAL_TOKENS = 2  # [CLS] and [SEP]
+MIN_CHUNK_FRACTION = 0.25  # sections smaller than this share of the budget are merged
+
+# Metadata key holding the heading path of a chunk
+SECTION_KEY = "section"
+
+HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+LIST_ITEM_RE = re.compile(r"^\s*(?:\d+[.)]|[-*+])\s+")
+TABLE_ROW_RE = re.compile(r"^\s*\|")
+TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-{3,}")
+FENCE_RE = re.compile(r"^\s*(```|~~~)")
+IMAGE_RE = re.compile(r"^\s*<!--\s*image\s*-->\s*$")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?:;])\s+")
+
+class Block:
+    """A structural Markdown element with its char span in the source text."""
+    def __init__(self, kind: str, start: int, end: int, text: str, section: str, items=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.text = text
+        self.section = section
+        self.items = items or []  # (start, end) of list items or table rows
+
+def _lines(text: str):
+    """Yields (start, end, line) with end excluding the newline."""
+    pos = 0
+    for line in text.split("\n"):
+        yield pos, pos + len(line), line
+        pos += len(line) + 1
+
+def _is_block_start(line: str) -> bool:
+    return bool(HEADING_RE.match(line) or TABLE_ROW_RE.match(line) or FENCE_RE.match(line))
+
+def parse_blocks(text: str) -> Iterator[Block]:
+    """
+    Splits Docling Markdown into headings, tables, lists, code, pictures and
+    paragraphs. Tracks the heading path so every block knows its section.
+    """
+    headings = []
+    lines = list(_lines(text))
+    i = 0
+
+    def block(kind, first, last, items=None):
+        start, end = lines[first][0], lines[last][1]
+        section = " > ".join(title for _, title in headings)
+        return Block(kind, start, end, text[start:end], section, items)
+
+    while i < len(lines):
+        line = lines[i][2]
+        if not line.strip():
+            i += 1
+            continue
+
+        heading = HEADING_RE.match(line)
+        if heading:
+            level = len(heading.group(1))
+            headings = [(l, t) for l, t in headings if l < level] + [(level, heading.group(2))]
+            yield block("heading", i, i)
+            i += 1
+            continue
+
+        fence = FENCE_RE.match(line)
+        if fence:
+            j = i + 1
+            while j < len(lines) - 1 and not lines[j][2].strip().startswith(fence.group(1)):
+                j += 1
+            yield block("code", i, min(j, len(lines) - 1))
+            i = j + 1
+            continue
+
+        if TABLE_ROW_RE.match(line):
+            j = i
+            while j + 1 < len(lines) and TABLE_ROW_RE.match(lines[j + 1][2]):
+                j += 1
+            rows = [(lines[k][0], lines[k][1]) for k in range(i, j + 1)]
+            yield block("table", i, j, rows)
+            i = j + 1
+            continue
+
+        if LIST_ITEM_RE.match(line):
+            items = []
+            item_start = j = i
+            while j + 1 < len(lines):
+                nxt = lines[j + 1][2]
+                if LIST_ITEM_RE.match(nxt):
+                    items.append((lines[item_start][0], lines[j][1]))
+                    item_start = j + 1
+                elif nxt.strip():
+                    # Indented or lazy continuation of the current item
+                    if _is_block_start(nxt):
+                        break
+                else:
+                    # Blank lines inside numbered procedures: the list goes on
+                    # if the next text is another item or an indented continuation
+                    k = j + 1
+                    while k < len(lines) and not lines[k][2].strip():
+                        k += 1
+                    if k == len(lines):
+                        break
+                    if LIST_ITEM_RE.match(lines[k][2]):
+                        items.append((lines[item_start][0], lines[j][1]))
+                        item_start = k
+                    elif not lines[k][2].startswith((" ", "\t")):
+                        break
+                    j = k
+                    continue
+                j += 1
+            items.append((lines[item_start][0], lines[j][1]))
+            yield block("list", i, j, items)
+            i = j + 1
+            continue
+
+        # Paragraph, or a Docling picture placeholder with its description
+        kind = "picture" if IMAGE_RE.match(line) else "paragraph"
+        j = i
+        if kind == "picture":
+            while j + 1 < len(lines) and not lines[j + 1][2].strip():
+                j += 1
+            if j + 1 < len(lines) and _is_block_start(lines[j + 1][2]):
+                j = i
+        while (
+            j + 1 < len(lines)
+            and lines[j + 1][2].strip()
+            and not _is_block_start(lines[j + 1][2])
+            and not (kind == "paragraph" and LIST_ITEM_RE.match(lines[j + 1][2]))
+        ):
+            j += 1
+        yield block(kind, i, j)
+        i = j + 1
+
+def _has_table_header(source: str, block: Block) -> bool:
+    return (
+        block.kind == "table"
+        and len(block.items) > 2
+        and bool(TABLE_SEPARATOR_RE.match(source[block.items[1][0]:block.items[1][1]]))
+    )
+
+def clip_block(source: str, block: Block, start: int, end: int) -> Block | None:
+    """
+    Restricts a block to the char span [start, end). A clipped table keeps
+    its header rows so every piece of it stays readable.
+    """
+    if block.end <= start or block.start >= end:
+        return None
+    if block.start >= start and block.end <= end:
+        return block
+
+    items = [(max(a, start), min(b, end)) for a, b in block.items if b > start and a < end]
+    if _has_table_header(source, block):
+        header = block.items[:2]
+        rows = [(a, b) for a, b in items if a >= header[1][1]]
+        if rows and rows[0][0] > header[1][1]:
+            text = source[header[0][0]:header[1][1]] + "\n" + source[rows[0][0]:rows[-1][1]]
+            return Block("table", rows[0][0], rows[-1][1], text, block.section, header + rows)
+
+    clip_start, clip_end = max(block.start, start), min(block.end, end)
+    return Block(block.kind, clip_start, clip_end, source[clip_start:clip_end], block.section, items)
+
+class DocumentBlocks:
+    """
+    A node's text parsed once into blocks. Chunking many spans of the same
+    node (children of each parent) selects blocks by offset instead of
+    re-parsing and re-hashing the whole text per span.
+    """
+    def __init__(self, node: BaseNode):
+        self.source = node.get_content(metadata_mode=MetadataMode.NONE)
+        self.source_info = node.as_related_node_info()
+        self.blocks = list(parse_blocks(self.source))
+        self._ends = [block.end for block in self.blocks]
+
+    def overlapping(self, start: int, end: int) -> Iterator[Block]:
+        """Blocks overlapping the char span [start, end), in order."""
+        i = bisect_right(self._ends, start)
+        while i < len(self.blocks) and self.blocks[i].start < end:
+            yield self.blocks[i]
+            i += 1
+
+class MarkdownStructureChunker(NodeParser):
+    """
+    Structure-aware, token-exact chunker for Docling Markdown.
+
+    - Chunks end at headings, so a chunk never spans two sections
+      (unless a section is too small to stand alone)
+    - Tables, numbered procedures and picture descriptions stay whole
+      when they fit; otherwise they are split at row/item boundaries,
+      repeating the table header
+    - Every chunk, including its embedded metadata, fits `max_tokens` of
+      the embedding model's tokenizer, so Ollama never rejects it for length
+    """
+    max_tokens: int = Field(default=EMBED_MAX_TOKENS, description="Token limit per chunk, metadata included.")
+    tokenizer_name: str = Field(default=EMBED_TOKENIZER, description="Hugging Face tokenizer used for counting.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MarkdownStructureChunker"
+
+    def _count(self, text: str) -> int:
+        return get_token_counter(self.tokenizer_name, strict=True).count(text)
+
+    def _budget(self, node: BaseNode, section: str) -> int:
+        """Tokens left for chunk text once the embedded metadata is accounted for."""
+        probe = TextNode(
+            text="",
+            metadata={**node.metadata, SECTION_KEY: section},
+            excluded_embed_metadata_keys=node.excluded_embed_metadata_keys,
+            metadata_template=node.metadata_template,
+            metadata_separator=node.metadata_separator,
+            text_template=node.text_template,
+        )
+        overhead = self._count(probe.get_content(metadata_mode=MetadataMode.EMBED))
+        budget = self.max_tokens - SPECIAL_TOKENS - overhead
+        if budget <= 0:
+            raise ValueError(f"Metadata alone exceeds {self.max_tokens} tokens for node {node.node_id}.")
+        return budget
+
+    def _hard_split(self, text: str, start: int, budget: int) -> Iterator[tuple[str, int, int]]:
+        """Longest prefixes that fit the budget, cut at whitespace where possible."""
+        while text:
+            if self._count(text) <= budget:
+                yield text, start, start + len(text)
+                return
+            lo, hi = 1, len(text)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self._count(text[:mid]) <= budget:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            cut = text.rfind(" ", 0, lo)
+            cut = cut if cut > lo // 2 else lo
+            yield text[:cut], start, start + cut
+            rest = text[cut:]
+            stripped = rest.lstrip()
+            start += cut + len(rest) - len(stripped)
+            text = stripped
+
+    def _split_spans(self, source: str, spans: list[tuple[int, int]], budget: int, prefix: str = ""):
+        """Packs consecutive spans (sentences, items, rows) into pieces within budget."""
+        piece = []
+        for span_start, span_end in spans:
+            candidate = piece + [(span_start, span_end)]
+            text = prefix + source[candidate[0][0]:candidate[-1][1]]
+            if self._count(text) <= budget:
+                piece = candidate
+                continue
+            if piece:
+                yield prefix + source[piece[0][0]:piece[-1][1]], piece[0][0], piece[-1][1]
+            if self._count(prefix + source[span_start:span_end]) <= budget:
+                piece = [(span_start, span_end)]
+            else:
+                piece = []
+                yield from self._hard_split(source[span_start:span_end], span_start, budget)
+        if piece:
+            yield prefix + source[piece[0][0]:piece[-1][1]], piece[0][0], piece[-1][1]
+
+    def _units(self, source: str, block: Block, budget: int) -> Iterator[tuple[str, int, int]]:
+        """Yields (text, start, end) units of a block, each within budget."""
+        if self._count(block.text) <= budget:
+            yield block.text, block.start, block.end
+            return
+
+        if _has_table_header(source, block):
+            header = source[block.items[0][0]:block.items[1][1]] + "\n"
+            yield from self._split_spans(source, block.items[2:], budget, prefix=header)
+        elif block.kind in ("table", "list") and len(block.items) > 1:
+            yield from self._split_spans(source, block.items, budget)
+        else:
+            sentences = []
+            pos = block.start
+            for match in SENTENCE_END_RE.finditer(block.text):
+                sentences.append((pos, block.start + match.start()))
+                pos = block.start + match.end()
+            sentences.append((pos, block.end))
+            yield from self._split_spans(source, sentences, budget)
+
+    @staticmethod
+    def _text(source: str, units: list) -> str:
+        if all(text == source[start:end] for text, start, end in units):
+            return source[units[0][1]:units[-1][2]]
+        return "\n\n".join(u[0] for u in units)
+
+    def _make_chunk(self, node: BaseNode, blocks: DocumentBlocks, units: list, section: str) -> TextNode:
+        source = blocks.source
+        return TextNode(
+            text=self._text(source, units),
+            metadata={**node.metadata, SECTION_KEY: section},
+            excluded_embed_metadata_keys=list(node.excluded_embed_metadata_keys),
+            excluded_llm_metadata_keys=list(node.excluded_llm_metadata_keys),
+            metadata_template=node.metadata_template,
+            metadata_separator=node.metadata_separator,
+            text_template=node.text_template,
+            start_char_idx=units[0][1],
+            end_char_idx=units[-1][2],
+            relationships={NodeRelationship.SOURCE: blocks.source_info},
+        )
+
+    def iter_chunks(
+        self, node: BaseNode, span: tuple[int, int] | None = None, blocks: DocumentBlocks | None = None
+    ) -> Iterator[TextNode]:
+        """
+        Streams chunks of one node in document order, optionally only the
+        char span [start, end) of it (used to cut children out of a parent).
+        Pass `blocks` of the node when chunking several spans of it.
+        Char offsets are relative to the node's text.
+        """
+        if blocks is None:
+            blocks = DocumentBlocks(node)
+        source = blocks.source
+        budgets = {}
+
+        def budget_for(section):
+            if section not in budgets:
+                budgets[section] = self._budget(node, section)
+            return budgets[section]
+
+        units = []
+        section = ""
+        n_headings = 0  # heading units at the end of `units`
+
+        for block in blocks.blocks if span is None else blocks.overlapping(*span):
+            if span is not None:
+                block = clip_block(source, block, *span)
+                if block is None:
+                    continue
+
+            headings_only = n_headings == len(units)
+            if block.kind == "heading" and not headings_only:
+                # New section: close the chunk unless it is too small to stand alone
+                if self._count(self._text(source, units)) >= budget_for(section) * MIN_CHUNK_FRACTION:
+                    yield self._make_chunk(node, blocks, units, section)
+                    units, n_headings, headings_only = [], 0, True
+
+            if headings_only:
+                section = block.section
+
+            # A unit must fit both the current chunk and a fresh one in this block's
+            # section, next to the trailing headings it carries into a fresh chunk
+            unit_budget = min(budget_for(section), budget_for(block.section))
+            if n_headings:
+                reserve = self._count(self._text(source, units[-n_headings:]))
+                if reserve <= unit_budget * (1 - MIN_CHUNK_FRACTION):
+                    unit_budget -= reserve
+
+            for unit in self._units(source, block, unit_budget):
+                if units and self._count(self._text(source, units + [unit])) > budget_for(section):
+                    # Trailing headings move on with their content; only a chunk of
+                    # nothing but headings is closed as is
+                    carry = n_headings if n_headings < len(units) else 0
+                    yield self._make_chunk(node, blocks, units[:len(units) - carry], section)
+                    units = units[len(units) - carry:]
+                    n_headings = carry
+                    section = block.section
+                units.append(unit)
+                n_headings = n_headings + 1 if block.kind == "heading" else 0
+
+        if units:
+            yield self._make_chunk(node, blocks, units, section)
+
+    def _parse_nodes(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> List[BaseNode]:
+        return [chunk for node in nodes for chunk in self.iter_chunks(node)]
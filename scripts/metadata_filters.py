@@ -0,0 +1,101 @@
+from datetime import date, datetime, time, timedelta, timezone
+from typing import TYPE_CHECKING
+from pydantic import BaseModel
+
+# qdrant_client is imported on first use; it is heavy and the CLI needs
+# SearchFilters before anything talks to Qdrant
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient, models
+
+# Source assumed for bare document ids ("3" -> "paperless:3")
+DEFAULT_SOURCE = "paperless"
+
+def payload_indexes() -> list[dict]:
+    """
+    Filterable payload fields and their Qdrant index types.
+    LlamaIndex overwrites the payload's `doc_id` with `ref_doc_id`, which is
+    the stable source key (see ingestion.document_source_key); we filter on that.
+    """
+    from qdrant_client import models
+
+    return [
+        {"field_name": "ref_doc_id", "field_schema": models.PayloadSchemaType.KEYWORD},
+        {"field_name": "source", "field_schema": models.PayloadSchemaType.KEYWORD},
+        {"field_name": "tags", "field_schema": models.PayloadSchemaType.INTEGER},
+        {"field_name": "created", "field_schema": models.PayloadSchemaType.DATETIME},
+    ]
+
+class SearchFilters(BaseModel):
+    """
+    Optional restrictions on what a query searches. Fields are ANDed;
+    values within `documents` and `tags` are ORed. Dates are inclusive.
+    """
+    documents: list[str] | None = None  # source keys ("paperless:3") or bare Paperless ids ("3")
+    tags: list[int] | None = None
+    source: str | None = None
+    created_from: date | None = None
+    created_to: date | None = None
+
+    def is_empty(self) -> bool:
+        return not (self.documents or self.tags or self.source or self.created_from or self.created_to)
+
+    def document_keys(self) -> list[str]:
+        return [d if ":" in d else f"{self.source or DEFAULT_SOURCE}:{d}" for d in self.documents or []]
+
+    def created_range(self) -> tuple[datetime | None, datetime | None]:
+        """Half-open UTC range [start, end) covering the inclusive date range."""
+        start = datetime.combine(self.created_from, time(), timezone.utc) if self.created_from else None
+        end = datetime.combine(self.created_to + timedelta(days=1), time(), timezone.utc) if self.created_to else None
+        return start, end
+
+def active_filters(filters: SearchFilters | None) -> SearchFilters | None:
+    """None for missing or empty filters, so both hit the unfiltered paths and cache keys."""
+    return None if filters is None or filters.is_empty() else filters
+
+def parse_created(value) -> float | None:
+    """Epoch seconds of a `created` metadata value (ISO date or datetime); naive means UTC."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def to_qdrant_filter(filters: SearchFilters | None) -> "models.Filter | None":
+    """Translates filters into a Qdrant filter over the indexed payload fields."""
+    filters = active_filters(filters)
+    if filters is None:
+        return None
+    from qdrant_client import models
+
+    must = []
+    if filters.documents:
+        must.append(models.FieldCondition(key="ref_doc_id", match=models.MatchAny(any=filters.document_keys())))
+    if filters.source:
+        must.append(models.FieldCondition(key="source", match=models.MatchValue(value=filters.source)))
+    if filters.tags:
+        must.append(models.FieldCondition(key="tags", match=models.MatchAny(any=filters.tags)))
+    start, end = filters.created_range()
+    if start or end:
+        must.append(models.FieldCondition(key="created", range=models.DatetimeRange(gte=start, lt=end)))
+    return models.Filter(must=must)
+
+def ensure_payload_indexes(client: "QdrantClient", collection_name: str):
+    """
+    Creates missing payload indexes. QdrantVectorStore only creates them
+    together with a new collection, so existing collections need this.
+    """
+    if not client.collection_exists(collection_name):
+        return
+    existing = client.get_collection(collection_name).payload_schema or {}
+    for index in payload_indexes():
+        if index["field_name"] not in existing:
+            print(f"🗂️ Creating payload index on '{index['field_name']}'...")
+            client.create_payload_index(
+                collection_name=collection_name,
+                field_name=index["field_name"],
+                field_schema=index["field_schema"],
+            )
@@ -0,0 +1,137 @@
+import os
+from typing import TYPE_CHECKING
+from dotenv import load_dotenv
+from llama_index.core.schema import TextNode, NodeWithScore, NodeRelationship, RelatedNodeInfo
+from retrieval_cache import LRUCache
+from robustness import call_protected
+
+# qdrant_client is imported on first use, see hybrid_retrieval
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION")
+QDRANT_PARENT_COLLECTION = os.getenv("QDRANT_PARENT_COLLECTION", f"{QDRANT_COLLECTION}_parents")
+PARENT_CACHE_SIZE = int(os.getenv("PARENT_CACHE_SIZE", 1024))
+
+# Metadata key on child chunks pointing at their parent section
+PARENT_ID_KEY = "parent_id"
+
+parent_cache = LRUCache(PARENT_CACHE_SIZE)
+
+def store_parents(parents: list[TextNode], client: "QdrantClient | None" = None):
+    """
+    Upserts parent sections into a payload-only Qdrant collection.
+    Parents are never searched, only fetched by id after reranking.
+    """
+    from qdrant_client import QdrantClient, models
+
+    client = client or QdrantClient(url=QDRANT_URL)
+    if not client.collection_exists(QDRANT_PARENT_COLLECTION):
+        client.create_collection(collection_name=QDRANT_PARENT_COLLECTION, vectors_config={})
+
+    client.upsert(
+        collection_name=QDRANT_PARENT_COLLECTION,
+        points=[
+            models.PointStruct(
+                id=parent.node_id,
+                vector={},
+                payload={
+                    "text": parent.get_content(),
+                    "metadata": parent.metadata,
+                    "ref_doc_id": parent.ref_doc_id,
+                    "start": parent.start_char_idx,
+                    "end": parent.end_char_idx,
+                },
+            )
+            for parent in parents
+        ],
+    )
+
+def delete_parents(ref_doc_id: str, client: "QdrantClient | None" = None):
+    """Deletes all parent sections of a source document."""
+    from qdrant_client import QdrantClient, models
+
+    client = client or QdrantClient(url=QDRANT_URL)
+    if not client.collection_exists(QDRANT_PARENT_COLLECTION):
+        return
+    client.delete(
+        collection_name=QDRANT_PARENT_COLLECTION,
+        points_selector=models.FilterSelector(
+            filter=models.Filter(
+                must=[models.FieldCondition(key="ref_doc_id", match=models.MatchValue(value=ref_doc_id))]
+            )
+        ),
+    )
+
+def _payload_to_node(point_id, payload: dict) -> TextNode:
+    node = TextNode(
+        id_=str(point_id),
+        text=payload["text"],
+        metadata=payload["metadata"],
+        start_char_idx=payload["start"],
+        end_char_idx=payload["end"],
+    )
+    if payload["ref_doc_id"]:
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=payload["ref_doc_id"])
+    return node
+
+def fetch_parents(parent_ids: list[str], client: "QdrantClient | None" = None) -> dict[str, TextNode]:
+    """Fetches parent sections by id, one round trip for all cache misses."""
+    parents = {}
+    missing = []
+    for parent_id in parent_ids:
+        node = parent_cache.get(parent_id)
+        if node is None:
+            missing.append(parent_id)
+        else:
+            parents[parent_id] = node
+
+    if missing:
+        from qdrant_client import QdrantClient
+
+        client = client or QdrantClient(url=QDRANT_URL)
+        points = call_protected(
+            "qdrant", client.retrieve, collection_name=QDRANT_PARENT_COLLECTION, ids=missing, with_payload=True
+        )
+        for point in points:
+            node = _payload_to_node(point.id, point.payload)
+            parent_cache.put(node.node_id, node)
+            parents[node.node_id] = node
+    return parents
+
+def expand_to_parents(nodes: list[NodeWithScore]) -> list[NodeWithScore]:
+    """
+    Replaces reranked child chunks by their parent sections for the final context.
+    Each parent appears once, with the best score of its children.
+    Chunks without a parent (flat ingestion) are passed through unchanged.
+    """
+    best = {}
+    for n in nodes:
+        parent_id = n.node.metadata.get(PARENT_ID_KEY)
+        if parent_id and (parent_id not in best or (n.score or 0.0) > (best[parent_id] or 0.0)):
+            best[parent_id] = n.score
+
+    if not best:
+        return nodes
+
+    try:
+        parents = fetch_parents(list(best))
+    except Exception as e:
+        print(f"⚠️ Failed to fetch parent sections, using child chunks: {e}")
+        return nodes
+
+    expanded = []
+    seen = set()
+    for n in nodes:
+        parent_id = n.node.metadata.get(PARENT_ID_KEY)
+        if parent_id not in parents:
+            expanded.append(n)
+        elif parent_id not in seen:
+            seen.add(parent_id)
+            expanded.append(NodeWithScore(node=parents[parent_id], score=best[parent_id]))
+    return expanded
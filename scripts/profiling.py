@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import random
+import itertools
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "profiles"),
+)
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "speedscope")  # "speedscope" or "html"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.001))  # seconds between samples
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 200))  # newest profile files kept on disk
+
+# Always-on sampling: this fraction of API requests is profiled, at a coarser
+# interval and never more than one at a time, so overhead stays bounded.
+# 0 disables it; an explicit request always profiles.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_SAMPLED_INTERVAL = float(os.getenv("PROFILE_SAMPLED_INTERVAL", 0.01))
+
+# Request header that asks for a profile of that request
+PROFILE_HEADER = "X-Profile"
+
+_sampled_slot = threading.Lock()
+_profile_seq = itertools.count()
+
+class ProfileHandle:
+    """Filled in when the profiled block exits."""
+    def __init__(self):
+        self.path = None
+        self.duration = None
+
+def _write_profile(profiler, name: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "-", name).strip("-")[:80]
+    stem = os.path.join(
+        PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_profile_seq)}-{safe_name}"
+    )
+
+    if PROFILE_FORMAT == "html":
+        path = stem + ".html"
+        output = profiler.output_html()
+    else:
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        path = stem + ".speedscope.json"
+        output = profiler.output(renderer=SpeedscopeRenderer())
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(output)
+    _prune_profiles()
+    return path
+
+def _prune_profiles(keep: int = PROFILE_KEEP):
+    # Other workers prune concurrently, so files may vanish while we look
+    files = []
+    for name in os.listdir(PROFILE_DIR):
+        path = os.path.join(PROFILE_DIR, name)
+        try:
+            files.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    files.sort()
+    for _, path in files[:-keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+@contextmanager
+def profiled(name: str, enabled: bool = True, interval: float = PROFILE_INTERVAL):
+    """
+    Sampling profile (pyinstrument) of the block, written as a speedscope or
+    HTML file. Wall-clock samples, so time spent waiting (LLM queue, HTTP
+    calls, other threads) shows up where the calling thread waited.
+    Only the current thread is sampled. A no-op if disabled or pyinstrument
+    is missing.
+    """
+    if not enabled:
+        yield None
+        return
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        print("⚠️ `pyinstrument` library missing, profiling disabled.")
+        print("Please run: pip install pyinstrument")
+        yield None
+        return
+
+    handle = ProfileHandle()
+    profiler = Profiler(interval=interval, async_mode="disabled")
+    profiler.start()
+    try:
+        yield handle
+    finally:
+        profiler.stop()
+        handle.duration = profiler.last_session.duration if profiler.last_session else None
+        try:
+            handle.path = _write_profile(profiler, name)
+            print(f"🔬 Profile of '{name}' written to {handle.path}")
+        except Exception as e:
+            print(f"⚠️ Failed to write profile: {e}")
+
+@contextmanager
+def request_profile(name: str, requested: bool = False):
+    """
+    Profiles one API request: always when `requested`, otherwise with
+    probability PROFILE_SAMPLE_RATE if no other sampled profile is running.
+    """
+    if requested:
+        with profiled(name) as handle:
+            yield handle
+        return
+
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        yield None
+        return
+    if not _sampled_slot.acquire(blocking=False):
+        yield None
+        return
+    try:
+        with profiled(f"sampled-{name}", interval=PROFILE_SAMPLED_INTERVAL) as handle:
+            yield handle
+    finally:
+        _sampled_slot.release()
+
+def header_requests_profile(value: str | None) -> bool:
+    return bool(value) and value.strip().lower() not in ("0", "false", "no", "off")
@@ -0,0 +1,145 @@
+import os
+import re
+import time
+import fcntl
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from llama_index.core.schema import NodeWithScore
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+COLLECTION_VERSION_FILE = os.getenv(
+    "COLLECTION_VERSION_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "collection_version"),
+)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", 2048))
+CANDIDATE_CACHE_SIZE = int(os.getenv("CANDIDATE_CACHE_SIZE", 512))
+CANDIDATE_CACHE_TTL = float(os.getenv("CANDIDATE_CACHE_TTL", 600))
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional time-to-live per entry.
+    """
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl is None or time.monotonic() - stored_at < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+embedding_cache = LRUCache(EMBED_CACHE_SIZE)
+candidate_cache = LRUCache(CANDIDATE_CACHE_SIZE, ttl=CANDIDATE_CACHE_TTL)
+
+def normalize_query(text: str) -> str:
+    """
+    Collapses whitespace only. This exact string is what gets embedded, so
+    queries sharing a cache key always share an embedding.
+    """
+    return re.sub(r"\s+", " ", text).strip()
+
+# --- Collection version ---
+# A counter in a shared file; ingestion bumps it after writing to Qdrant,
+# which invalidates cached candidates in every process.
+
+_version = (None, 0)  # (mtime_ns, version)
+
+def get_collection_version() -> int:
+    global _version
+    try:
+        mtime = os.stat(COLLECTION_VERSION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+    if _version[0] != mtime:
+        with open(COLLECTION_VERSION_FILE) as f:
+            _version = (mtime, int(f.read().strip() or 0))
+    return _version[1]
+
+def bump_collection_version() -> int:
+    os.makedirs(os.path.dirname(COLLECTION_VERSION_FILE), exist_ok=True)
+    with open(COLLECTION_VERSION_FILE + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            version = get_collection_version() + 1
+            tmp_path = f"{COLLECTION_VERSION_FILE}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(str(version))
+            os.replace(tmp_path, COLLECTION_VERSION_FILE)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    print(f"🔖 Collection version bumped to {version}.")
+    return version
+
+# --- Query embeddings ---
+
+def get_query_embedding(embed_model, query: str, compute=None) -> list[float]:
+    """`compute(query)` replaces the plain model call on a miss, e.g. to add a breaker."""
+    text = normalize_query(query)
+    key = (embed_model.model_name, text)
+    embedding = embedding_cache.get(key)
+    if embedding is None:
+        embedding = (compute or embed_model.get_query_embedding)(text)
+        embedding_cache.put(key, embedding)
+    return embedding
+
+def get_query_embeddings(embed_model, queries: list[str]) -> list[list[float]]:
+    """Batch variant: only the cache misses are sent to the model, in one request."""
+    texts = [normalize_query(q) for q in queries]
+    keys = [(embed_model.model_name, text) for text in texts]
+    embeddings = [embedding_cache.get(k) for k in keys]
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    if missing:
+        computed = embed_model.get_general_text_embeddings([texts[i] for i in missing])
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+            embedding_cache.put(keys[i], embedding)
+    return embeddings
+
+# --- Fused candidate lists ---
+
+def candidate_key(query: str, top_k: int, filters=None) -> tuple:
+    return (normalize_query(query), top_k, repr(filters), get_collection_version())
+
+def get_candidates(key: tuple) -> list[NodeWithScore] | None:
+    cached = candidate_cache.get(key)
+    if cached is None:
+        return None
+    # Rerankers overwrite NodeWithScore.score, so hand out fresh wrappers
+    return [NodeWithScore(node=n.node, score=n.score) for n in cached]
+
+def put_candidates(key: tuple, nodes: list[NodeWithScore]):
+    candidate_cache.put(key, [NodeWithScore(node=n.node, score=n.score) for n in nodes])
+
+def cache_stats() -> dict:
+    return {
+        "collection_version": get_collection_version(),
+        "embeddings": embedding_cache.stats(),
+        "candidates": candidate_cache.stats(),
+    }
@@ -1,35 +1,342 @@
 import time
+import random
+import asyncio
+import inspect
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, TimeoutError as FutureTimeout
 from functools import wraps
+import requests
 
-def retry_with_backoff(max_retries=3, initial_delay=1, backoff_factor=2, exceptions=(Exception,)):
+class DeadlineExceeded(TimeoutError):
+    """The request's time budget ran out before a stage could finish."""
+
+class CircuitOpenError(RuntimeError):
+    """A downstream service's circuit breaker is open; the call was not attempted."""
+
+# Errors that must never be retried: retrying cannot help and only burns the budget
+_NON_RETRYABLE = (DeadlineExceeded, CircuitOpenError)
+
+# --- Deadlines ---
+# The absolute deadline of the current request lives in a context variable, so it
+# follows the call chain (retrieval -> rerank -> generate) without being passed around.
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+@contextmanager
+def deadline(seconds: float | None):
+    """Sets a time budget for everything called inside the block."""
+    if seconds is None:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def time_remaining() -> float | None:
+    """Seconds left in the current budget, or None when there is no deadline."""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+def check_deadline(stage: str = ""):
+    remaining = time_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage or 'next stage'}.")
+
+def timeout_for(default: float) -> float:
+    """A per-call timeout that never outlives the current deadline."""
+    remaining = time_remaining()
+    if remaining is None:
+        return default
+    check_deadline()
+    return min(default, remaining)
+
+# --- Retries ---
+
+def _sleep_for(delay: float, jitter: bool) -> float:
+    # "Equal jitter": at least half the delay, so retries still back off
+    return delay / 2 + random.uniform(0, delay / 2) if jitter else delay
+
+def retry_with_backoff(max_retries=3, initial_delay=1, backoff_factor=2, exceptions=(Exception,), jitter=True):
     """
     Decorator to retry a function call with exponential backoff.
-    
+    Works for both sync and async functions; async ones sleep with asyncio.
+    Stops early instead of sleeping past the current deadline.
+
     Args:
         max_retries (int): Maximum number of retries.
         initial_delay (float): Initial delay in seconds.
         backoff_factor (float): Multiplier for delay after each failure.
         exceptions (tuple): Tuple of exceptions to catch and retry on.
+        jitter (bool): Randomize delays so clients do not retry in lockstep.
     """
+    def should_retry(e, attempt, sleep):
+        if isinstance(e, _NON_RETRYABLE) or attempt >= max_retries:
+            return False
+        remaining = time_remaining()
+        return remaining is None or remaining > sleep
+
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                delay = initial_delay
+                for attempt in range(max_retries + 1):
+                    try:
+                        return await func(*args, **kwargs)
+                    except exceptions as e:
+                        sleep = _sleep_for(delay, jitter)
+                        if not should_retry(e, attempt, sleep):
+                            if attempt >= max_retries:
+                                print(f"❌ All {max_retries} attempts failed.")
+                            raise
+                        print(f"⚠️ Attempt {attempt + 1}/{max_retries} failed: {e}. Retrying in {sleep:.1f}s...")
+                        await asyncio.sleep(sleep)
+                        delay *= backoff_factor
+            return async_wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             delay = initial_delay
-            last_exception = None
-            
             for attempt in range(max_retries + 1):
                 try:
                     return func(*args, **kwargs)
                 except exceptions as e:
-                    last_exception = e
-                    if attempt < max_retries:
-                        print(f"⚠️ Attempt {attempt + 1}/{max_retries} failed: {e}. Retrying in {delay}s...")
-                        time.sleep(delay)
-                        delay *= backoff_factor
-                    else:
-                        print(f"❌ All {max_retries} attempts failed.")
-            
-            if last_exception:
-                raise last_exception
+                    sleep = _sleep_for(delay, jitter)
+                    if not should_retry(e, attempt, sleep):
+                        if attempt >= max_retries:
+                            print(f"❌ All {max_retries} attempts failed.")
+                        raise
+                    print(f"⚠️ Attempt {attempt + 1}/{max_retries} failed: {e}. Retrying in {sleep:.1f}s...")
+                    time.sleep(sleep)
+                    delay *= backoff_factor
         return wrapper
     return decorator
+
+# --- Circuit breakers ---
+
+class CircuitBreaker:
+    """
+    Per-service circuit breaker.
+
+    closed    -> calls pass; `failure_threshold` consecutive failures open it
+    open      -> calls fail fast with CircuitOpenError for `reset_timeout` seconds
+    half_open -> one trial call; success closes, failure re-opens
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit for '{self.name}' is open.")
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_running:
+                    raise CircuitOpenError(f"Circuit for '{self.name}' is half-open, trial in progress.")
+                self._trial_running = True
+
+    def _on_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def _on_failure(self, e: Exception):
+        with self._lock:
+            self._trial_running = False
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"🔌 Circuit for '{self.name}' opened after: {e}")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
+
+    def call_with_timeout(self, timeout: float, func, /, *args, **kwargs):
+        """
+        Like `call`, but gives up after `timeout` seconds. The call runs on a
+        worker thread in a copy of our context; a timeout counts as a failure
+        and raises DeadlineExceeded, and the abandoned call ends in the background.
+        """
+        self._before_call()
+        future = _call_pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
+        try:
+            result = future.result(timeout=max(timeout, 0))
+        except FutureTimeout:
+            error = DeadlineExceeded(f"Deadline exceeded waiting for '{self.name}'.")
+            self._on_failure(error)
+            raise error from None
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
+
+    async def acall(self, func, *args, **kwargs):
+        self._before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
+
+    def __call__(self, func):
+        """Use as a decorator on sync or async functions."""
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await self.acall(func, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return wrapper
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures}
+
+# Runs deadline-bounded calls; a hung call keeps its worker until it returns
+_call_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="protected")
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(service: str) -> CircuitBreaker:
+    """Returns the process-wide breaker for a downstream service."""
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(service)
+        return _breakers[service]
+
+def breaker_stats() -> dict:
+    with _breakers_lock:
+        return {name: breaker.stats() for name, breaker in _breakers.items()}
+
+# --- Hedged requests ---
+# If the first attempt has not answered after `hedge_after` seconds, a second
+# identical request is sent and whichever answers first wins. Only for
+# idempotent reads (query embedding, vector search).
+
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+def hedged(func, *args, hedge_after: float = 0.5, max_attempts: int = 2, **kwargs):
+    futures = []
+    last_error = None
+
+    def launch():
+        # Each attempt runs in a copy of our context, so it sees the same deadline
+        ctx = contextvars.copy_context()
+        futures.append(_hedge_pool.submit(ctx.run, func, *args, **kwargs))
+
+    launch()
+    pending = set(futures)
+    while pending:
+        timeout = hedge_after if len(futures) < max_attempts else None
+        remaining = time_remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+            if timeout <= 0:
+                raise DeadlineExceeded("Deadline exceeded waiting for hedged request.")
+
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            last_error = future.exception()
+
+        # Hedge on a slow attempt, and also on a failed one
+        if len(futures) < max_attempts:
+            launch()
+            pending.add(futures[-1])
+
+    raise last_error
+
+async def ahedged(func, *args, hedge_after: float = 0.5, max_attempts: int = 2, **kwargs):
+    """Async variant of `hedged` for coroutine functions."""
+    tasks = [asyncio.ensure_future(func(*args, **kwargs))]
+    pending = set(tasks)
+    last_error = None
+    try:
+        while pending:
+            timeout = hedge_after if len(tasks) < max_attempts else None
+            remaining = time_remaining()
+            if remaining is not None:
+                timeout = remaining if timeout is None else min(timeout, remaining)
+                if timeout <= 0:
+                    raise DeadlineExceeded("Deadline exceeded waiting for hedged request.")
+
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                last_error = task.exception()
+
+            if len(tasks) < max_attempts:
+                tasks.append(asyncio.ensure_future(func(*args, **kwargs)))
+                pending.add(tasks[-1])
+        raise last_error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def call_protected(service: str, func, *args, hedge_after: float | None = None, **kwargs):
+    """
+    Calls a downstream service through its circuit breaker, after checking the
+    deadline. The call never outlives the deadline, even if the client has no
+    timeout of its own. With `hedge_after`, slow calls are hedged.
+    """
+    check_deadline(service)
+    breaker = get_breaker(service)
+    if hedge_after is not None:
+        return hedged(breaker.call, func, *args, hedge_after=hedge_after, **kwargs)
+    remaining = time_remaining()
+    if remaining is None:
+        return breaker.call(func, *args, **kwargs)
+    return breaker.call_with_timeout(remaining, func, *args, **kwargs)
+
+def protected_request(service: str, method: str, url: str, retries: int = 2, timeout: float = 30.0, **kwargs) -> requests.Response:
+    """
+    HTTP request to a downstream service (Paperless, Docling) with jittered
+    retries, a circuit breaker and a timeout bounded by the current deadline.
+    Connection errors and 5xx count against the breaker and are retried;
+    4xx raise once, since a retry would get the same answer.
+    Use retries=0 for non-idempotent calls such as uploads.
+    """
+    def send():
+        res = requests.request(method, url, timeout=timeout_for(timeout), **kwargs)
+        if res.status_code >= 500:
+            res.raise_for_status()
+        return res
+
+    @retry_with_backoff(max_retries=retries, initial_delay=1, backoff_factor=2, exceptions=(requests.RequestException,))
+    def attempt():
+        return call_protected(service, send)
+
+    res = attempt()
+    res.raise_for_status()
+    return res
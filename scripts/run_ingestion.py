@@ -1,11 +1,13 @@
 import os
-import requests
 import json
+import argparse
 import time
 import re
 from dotenv import load_dotenv
 from llama_index.core import Document
 from ingestion import ingest_documents
+from robustness import protected_request
+from profiling import profiled
 
 # Load environment variables
 load_dotenv()
@@ -21,8 +23,7 @@ def get_documents(limit=10):
     print(f"📥 Fetching last {limit} documents from Paperless...")
     url = f"{PAPERLESS_URL}/api/documents/?page_size={limit}&ordering=-created"
     try:
-        res = requests.get(url, headers=PAPERLESS_HEADERS)
-        res.raise_for_status()
+        res = protected_request("paperless", "GET", url, headers=PAPERLESS_HEADERS)
         return res.json()['results']
     except Exception as e:
         print(f"❌ Failed to fetch documents: {e}")
@@ -32,8 +33,7 @@ def download_document(doc_id, original_filename):
     """Downloads a document from Paperless to a temp file."""
     url = f"{PAPERLESS_URL}/api/documents/{doc_id}/download/"
     try:
-        res = requests.get(url, headers=PAPERLESS_HEADERS, stream=True)
-        res.raise_for_status()
+        res = protected_request("paperless", "GET", url, headers=PAPERLESS_HEADERS, stream=True)
         
         temp_path = f"/tmp/{original_filename}"
         with open(temp_path, 'wb') as f:
@@ -61,8 +61,8 @@ def process_docling_async(file_path):
     
     try:
         print(f"🚀 Sending {os.path.basename(file_path)} to Docling...")
-        res = requests.post(submit_url, files=files, data=data)
-        res.raise_for_status()
+        # Not retried: a retry after a lost response would start a second conversion
+        res = protected_request("docling", "POST", submit_url, retries=0, timeout=300, files=files, data=data)
         task_id = res.json()['task_id']
     except Exception as e:
         print(f"❌ Docling upload failed: {e}")
@@ -75,13 +75,12 @@ def process_docling_async(file_path):
     start = time.time()
     while time.time() - start < 3600: # 60 min timeout
         try:
-            status_res = requests.get(poll_url)
-            status_res.raise_for_status()
+            status_res = protected_request("docling", "GET", poll_url, retries=0)
             status = status_res.json().get('task_status')
             
             if status == 'success':
                 print("✅ Docling processing complete.")
-                return requests.get(result_url).json()
+                return protected_request("docling", "GET", result_url, timeout=300).json()
             elif status == 'failure':
                 print("❌ Docling task failed.")
                 return None
@@ -170,4 +169,9 @@ def run_ingestion_test():
         print("No documents successfully processed.")
 
 if __name__ == "__main__":
-    run_ingestion_test()
+    parser = argparse.ArgumentParser(description="Ingest recent Paperless documents.")
+    parser.add_argument("--profile", action="store_true", help="Write a sampling profile (speedscope) of the run")
+    args = parser.parse_args()
+
+    with profiled("run-ingestion", enabled=args.profile):
+        run_ingestion_test()
@@ -0,0 +1,111 @@
+import re
+import pytest
+from llama_index.core import Document
+from llama_index.core.schema import MetadataMode
+import markdown_chunker
+from markdown_chunker import MarkdownStructureChunker, DocumentBlocks, SPECIAL_TOKENS, SECTION_KEY
+from token_counting import TokenCounter
+
+class WordCounter:
+    """One token per whitespace-separated word; stands in for the Hugging Face tokenizer."""
+    def count(self, text: str) -> int:
+        return len(re.findall(r"\S+", text))
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(markdown_chunker, "get_token_counter", lambda name=None, strict=False: WordCounter())
+
+TABLE_HEADER = "| Part | Torque |\n|---|---|"
+
+def sample_document() -> Document:
+    rows = "\n".join(f"| bolt {i} | {i * 5} Nm |" for i in range(40))
+    steps = "\n".join(f"{i}. Tighten bolt {i} to the listed torque." for i in range(1, 9))
+    prose = " ".join(f"Sentence {i} explains the inspection in some detail." for i in range(30))
+    text = (
+        "# Maintenance\n\nIntro paragraph for the manual.\n\n"
+        f"## Torques\n\n{TABLE_HEADER}\n{rows}\n\n"
+        f"## Procedure\n\n{steps}\n\n"
+        f"## Inspection\n\n{prose}\n"
+    )
+    return Document(text=text, metadata={"title": "Manual"})
+
+def test_chunk_offsets_match_source():
+    document = sample_document()
+    chunks = list(MarkdownStructureChunker(max_tokens=60).iter_chunks(document))
+    header_at = document.text.index(TABLE_HEADER)
+
+    assert len(chunks) > 3
+    for chunk in chunks:
+        assert chunk.start_char_idx < chunk.end_char_idx
+        original = document.text[chunk.start_char_idx:chunk.end_char_idx]
+        if chunk.text.startswith(TABLE_HEADER) and chunk.start_char_idx != header_at:
+            # Repeated header, then the rows the offsets point at
+            assert chunk.text == TABLE_HEADER + "\n" + original
+        else:
+            assert chunk.text == original
+    starts = [chunk.start_char_idx for chunk in chunks]
+    assert starts == sorted(starts)
+
+def test_chunks_fit_budget_with_metadata():
+    chunker = MarkdownStructureChunker(max_tokens=60)
+    for chunk in chunker.iter_chunks(sample_document()):
+        embedded = chunk.get_content(metadata_mode=MetadataMode.EMBED)
+        assert WordCounter().count(embedded) + SPECIAL_TOKENS <= 60
+
+def test_chunks_stay_in_their_section():
+    chunks = list(MarkdownStructureChunker(max_tokens=60).iter_chunks(sample_document()))
+    procedure = [c for c in chunks if "Tighten bolt" in c.text]
+
+    assert procedure
+    assert all(c.metadata[SECTION_KEY].endswith("Procedure") for c in procedure)
+    assert all("Sentence" not in c.text and "Nm" not in c.text for c in procedure)
+
+def test_split_table_repeats_header():
+    document = sample_document()
+    chunks = [c for c in MarkdownStructureChunker(max_tokens=60).iter_chunks(document) if "| bolt" in c.text]
+
+    assert len(chunks) > 1
+    rows = []
+    for chunk in chunks:
+        # The first piece also carries the section heading
+        assert chunk.text.removeprefix("## Torques\n\n").startswith(TABLE_HEADER)
+        rows.extend(line for line in chunk.text.splitlines() if line.startswith("| bolt"))
+    assert rows == [f"| bolt {i} | {i * 5} Nm |" for i in range(40)]
+
+def test_hard_split_offsets_and_budget():
+    chunker = MarkdownStructureChunker(max_tokens=60)
+    source = "x" * 7 + " " + " ".join(f"word{i}" for i in range(100))
+    pieces = list(chunker._hard_split(source[8:], 8, 12))
+
+    assert len(pieces) == 9
+    for text, start, end in pieces:
+        assert text == source[start:end]
+        assert WordCounter().count(text) <= 12
+        assert not text.startswith(" ") and not text.endswith(" ")
+    assert " ".join(text for text, _, _ in pieces) == source[8:]
+
+def test_children_from_shared_blocks_match_reparsing():
+    document = sample_document()
+    blocks = DocumentBlocks(document)
+    parents = list(MarkdownStructureChunker(max_tokens=120).iter_chunks(document, blocks=blocks))
+    child_chunker = MarkdownStructureChunker(max_tokens=40)
+
+    assert len(parents) > 1
+    for parent in parents:
+        span = (parent.start_char_idx, parent.end_char_idx)
+        shared = child_chunker.iter_chunks(document, span=span, blocks=blocks)
+        reparsed = child_chunker.iter_chunks(document, span=span)
+        assert [(c.text, c.start_char_idx, c.end_char_idx) for c in shared] == [
+            (c.text, c.start_char_idx, c.end_char_idx) for c in reparsed
+        ]
+
+def test_strict_tokenizer_does_not_fall_back():
+    with pytest.raises(RuntimeError):
+        TokenCounter("no-such-org/no-such-tokenizer", strict=True)
+
+@pytest.mark.parametrize("max_tokens", [40, 60, 120, 256])
+def test_headings_stay_with_their_content(max_tokens):
+    for chunk in MarkdownStructureChunker(max_tokens=max_tokens).iter_chunks(sample_document()):
+        lines = [line for line in chunk.text.splitlines() if line.strip()]
+        assert not all(line.startswith("#") for line in lines)
+        assert not lines[-1].startswith("#")
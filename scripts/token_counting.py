@@ -0,0 +1,75 @@
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+# Hugging Face tokenizer matching the Ollama LLM (e.g. "meta-llama/Llama-3.1-8B-Instruct").
+# Ollama does not expose its tokenizer, so without this we fall back to tiktoken.
+# Only this budget counter may fall back; chunk sizing for the embedding model
+# loads its tokenizer strictly, since another vocabulary can overrun its limit.
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER")
+FALLBACK_ENCODING = "cl100k_base"
+
+def _fallback_encoding():
+    """
+    tiktoken's FALLBACK_ENCODING, read from the cache bundled with llama_index
+    unless TIKTOKEN_CACHE_DIR is set, so it loads without internet access.
+    """
+    import tiktoken
+    import llama_index.core
+
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+    os.environ["TIKTOKEN_CACHE_DIR"] = os.path.join(
+        os.path.dirname(os.path.abspath(llama_index.core.__file__)), "_static", "tiktoken_cache"
+    )
+    try:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+    finally:
+        del os.environ["TIKTOKEN_CACHE_DIR"]
+
+class TokenCounter:
+    """
+    Thin wrapper giving a Hugging Face tokenizer and tiktoken the same interface.
+    With `strict`, a tokenizer that cannot be loaded raises instead of
+    falling back to tiktoken.
+    """
+    def __init__(self, name: str | None = None, strict: bool = False):
+        self.name = name or FALLBACK_ENCODING
+        self._hf = None
+        self._tiktoken = None
+        if name:
+            try:
+                from transformers import AutoTokenizer
+                self._hf = AutoTokenizer.from_pretrained(name)
+            except Exception as e:
+                if strict:
+                    raise RuntimeError(
+                        f"Could not load tokenizer '{name}': {e}. "
+                        "Please run: pip install transformers"
+                    ) from e
+                print(f"⚠️ Could not load tokenizer '{name}': {e}. Falling back to {FALLBACK_ENCODING}.")
+                self.name = FALLBACK_ENCODING
+        if self._hf is None:
+            self._tiktoken = _fallback_encoding()
+
+    def encode(self, text: str) -> list[int]:
+        if self._hf is not None:
+            return self._hf.encode(text, add_special_tokens=False)
+        return self._tiktoken.encode(text)
+
+    def decode(self, token_ids: list[int]) -> str:
+        if self._hf is not None:
+            return self._hf.decode(token_ids)
+        return self._tiktoken.decode(token_ids)
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+@lru_cache(maxsize=None)
+def get_token_counter(name: str | None = None, strict: bool = False) -> TokenCounter:
+    """Returns a cached TokenCounter; `None` selects the LLM tokenizer."""
+    return TokenCounter(name or LLM_TOKENIZER, strict=strict)